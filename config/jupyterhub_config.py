@@ -6,9 +6,10 @@ import sys
 CONFIG_SCRIPT_DIR = os.getenv('CONFIG_SCRIPT_DIR', '/config')
 CONFIG_FILE = os.getenv('CONFIG_FILE', '/etc/jupyterhub/config.yaml')
 sys.path.append(CONFIG_SCRIPT_DIR)
-from MyConfig import MyConfig,my_pre_spawn_hook
+from MyConfig import MyConfig,my_pre_spawn_hook_async
 from MyOAuth import MyOAuth
-from MyDockerSpawner import MyDockerSpawner
+from MyDockerSpawner import MyDockerSpawner, ImagePrePuller
+from AdSync import AdSyncService
 import docker
 # ==============================================================================
 c = get_config()
@@ -26,6 +27,11 @@ c.MyOAuth.auto_login = True
 c.MyOAuth.discovery_url = "https://auth.example.com/realms/realm"+"/.well-known/openid-configuration"
 # or (you can add "/.well-known/openid-configuration" or not)
 c.MyOAuth.discovery_url = "https://auth.example.com/realms/realm"
+# The discovery document is cached, and kept in a file so that a restart does not wait for the OpenID Connect service
+# c.MyOAuth.discovery_cache_file = "/data/oidc_discovery.json"
+# c.MyOAuth.discovery_cache_ttl = 3600
+# Read the user from the ID token verified with the JWKS of the service, instead of requesting userinfo on every login
+# c.MyOAuth.verify_id_token = True
 c.MyOAuth.client_id = "code-oidc"
 c.MyOAuth.client_secret = "CHANGEIT"
 c.MyOAuth.scope = ['openid', 'profile', 'email', 'groups']
@@ -35,6 +41,13 @@ c.MyOAuth.login_service = 'Example'
 # If group is not defined, all users will be allowed
 GROUP = ['group1', 'group2', 'admins']
 c.MyOAuth.allowed_groups = GROUP
+# Keycloak group paths are mapped to groups by rules, by default /org/team gives both org and team
+# c.MyOAuth.group_mapping = [
+#     {'prefix': '/org', 'action': 'leaf'},                       # /org/team -> team
+#     {'prefix': '/org/staff', 'action': 'rename', 'name': 'staff'},
+#     {'prefix': '/projects', 'action': 'path'},                  # /projects/a -> projects/a
+#     {'prefix': '/tmp', 'action': 'drop'},
+# ]
 # users with `administrator` role will be marked as admin
 c.MyOAuth.admin_groups = ['Administrators', 'AdminJupyterHub','admins']
 c.MyOAuth.manage_groups = False
@@ -48,7 +61,11 @@ c.JupyterHub.load_roles = my_config.load_roles()
 c.JupyterHub.load_groups = my_config.load_groups()
 c.JupyterHub.services = my_config.services()
 
-c.Spawner.pre_spawn_hook = my_pre_spawn_hook
+# Preload and sync the local AD cache in the background (ad.preload and ad.sync in config.yaml)
+ad_sync = AdSyncService(lambda: MyConfig.snapshot(CONFIG_FILE).ad_user)
+ad_sync.start()
+
+c.Spawner.pre_spawn_hook = my_pre_spawn_hook_async
 
 c.JupyterHub.base_url = "/"
 
@@ -60,8 +77,18 @@ c.JupyterHub.hub_port = 8080
 c.JupyterHub.spawner_class = MyDockerSpawner
 
 
-# The allowed images are defined in config.yaml
-c.MyDockerSpawner.allowed_images = my_config.allowed_images()
+# The allowed images are defined in config.yaml, changes are used without a restart
+def allowed_images(spawner=None):
+    return MyConfig.snapshot(CONFIG_FILE).image_config.allowed_images()
+c.MyDockerSpawner.allowed_images = allowed_images
+
+# Pull the allowed images in the background, ready images are pinned to their digest
+image_puller = ImagePrePuller(allowed_images, concurrency=2, retries=3, interval=300,
+                              status_file='/data/image_pull_status.json')
+image_puller.start()
+MyDockerSpawner.image_puller = image_puller
+# Offer only the images which are pulled already
+# c.MyDockerSpawner.hide_unready_images = True
 
 # c.JupyterHub.cleanup_servers=False
 c.MyDockerSpawner.network_name = "jupyterhub"
@@ -0,0 +1,367 @@
+"""
+Replays a class start: K users log in within a short time and start their servers, against the local stand-ins of
+standins.py. Every user goes through
+
+    OAuth callback -> MyOAuth.authenticate (group mapping) -> check_allowed -> my_pre_spawn_hook_async -> start
+
+in one event loop, like the hub. Spawns wait for a free slot of --spawn-limit, like JupyterHub's
+concurrent_spawn_limit.
+
+    python src/bench/login_storm.py --users 300 --arrival ramp --duration 120 --ldap-latency 5 --start-latency 2000
+
+The report (JSON) has the latency of every phase, the queueing delay for a spawn slot, the lag of the event loop,
+the requests to the OpenID Connect service and the state of the caches.
+"""
+from __future__ import annotations
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import standins
+from standins import FakeGroup, FakeHandler, FakeSpawner, FakeUser, MockDirectory, OidcServer
+from spawn_path import percentile, versions
+
+from AdUsers import LdapPool
+from MyConfig import MyConfig, my_pre_spawn_hook_async
+from MyOAuth import GroupMapping, MyOAuth
+
+log = logging.getLogger('JupyterHub.bench')
+
+# authenticate includes groups, the group mapping done in authenticate and check_allowed.
+# login is the OAuth callback up to check_allowed.
+PHASES = ('authenticate', 'authorize', 'groups', 'login', 'queue', 'pre_spawn_hook', 'start', 'spawn', 'total')
+ARRIVALS = ('burst', 'ramp', 'poisson')
+
+# seconds spent in the group mapping by the login of the current task
+_group_seconds: ContextVar[list[float]] = ContextVar('group_seconds')
+
+
+class TimedGroupMapping:
+    """
+    a GroupMapping which records the time of every call in _group_seconds
+    """
+
+    def __init__(self, mapping: GroupMapping) -> None:
+        self.mapping = mapping
+
+    def __call__(self, groups):
+        start = time.perf_counter()
+        try:
+            return self.mapping(groups)
+        finally:
+            spent = _group_seconds.get(None)
+            if spent is not None:
+                spent.append(time.perf_counter() - start)
+
+
+def arrival_times(curve: str, users: int, duration: float, rng: random.Random) -> list[float]:
+    """
+    seconds after the start at which each user arrives.\n
+    burst: all at once. ramp: the rate grows linearly from 0 over duration. poisson: a constant rate of
+    users / duration with exponential gaps.
+    """
+    if curve == 'burst' or duration <= 0:
+        return [0.0] * users
+    if curve == 'ramp':
+        # the arrivals up to t grow with t², so the i-th arrives at duration * sqrt(i / users)
+        return [duration * math.sqrt(i / users) for i in range(users)]
+    if curve == 'poisson':
+        rate = users / duration
+        times = []
+        t = 0.0
+        for _ in range(users):
+            t += rng.expovariate(rate)
+            times.append(t)
+        return times
+    raise ValueError(f"unknown arrival curve {curve}")
+
+
+def summary(samples: list[float]) -> dict[str, float]:
+    """
+    count, mean, p50/p95/p99 and max of samples in milliseconds
+    """
+    samples = sorted(samples)
+    count = len(samples)
+    return {
+        'count': count,
+        'mean_ms': round(1000 * sum(samples) / count, 3) if count else 0.0,
+        'p50_ms': round(1000 * percentile(samples, 50), 3),
+        'p95_ms': round(1000 * percentile(samples, 95), 3),
+        'p99_ms': round(1000 * percentile(samples, 99), 3),
+        'max_ms': round(1000 * samples[-1], 3) if count else 0.0,
+    }
+
+
+@dataclass
+class StormConfig:
+    users: int = 100
+    arrival: str = 'burst'
+    # seconds over which the users arrive, for ramp and poisson
+    duration: float = 60
+    # users in the directory, at least users
+    size: int = 1000
+    # fraction of the users which start a named server instead of the default one
+    named_fraction: float = 0.3
+    # servers each user starts after the login, at the same time
+    servers_per_user: int = 1
+    # JupyterHub's concurrent_spawn_limit
+    spawn_limit: int = 100
+    # seconds, added to each LDAP search, OIDC request and container start
+    ldap_latency: float = 0
+    http_latency: float = 0
+    start_latency: float = 0
+    verify_id_token: bool = False
+    # fill the local and memory cache before the storm, as ad.preload does at hub start
+    preload: bool = False
+    # search AD on the event loop, see ad.async_ldap
+    async_ldap: bool = False
+    seed: int = 0
+
+
+@dataclass
+class StormStats:
+    phases: dict[str, list[float]] = field(default_factory=lambda: {phase: [] for phase in PHASES})
+    errors: dict[str, int] = field(default_factory=dict)
+    # seconds the event loop woke up later than asked
+    loop_lag: list[float] = field(default_factory=list)
+    # seconds a user was let in later than its arrival time
+    arrival_lag: list[float] = field(default_factory=list)
+    logins: int = 0
+    spawns: int = 0
+
+    def failed(self, phase: str, error: Exception):
+        self.errors[phase] = self.errors.get(phase, 0) + 1
+        log.debug("%s failed: %s", phase, error)
+
+
+class LoginStorm:
+    def __init__(self, config: StormConfig, directory: str) -> None:
+        self.config = config
+        self.directory = directory
+        self.rng = random.Random(config.seed)
+        self.stats = StormStats()
+        self.mock: MockDirectory = None
+        self.oidc: OidcServer = None
+        self.auth: MyOAuth = None
+        self.config_file: str = None
+        self.images: list[str] = []
+        self.spawn_slots: asyncio.Semaphore = None
+
+    def setup(self):
+        config = self.config
+        start = time.perf_counter()
+        self.mock = MockDirectory(max(config.size, config.users), latency=config.ldap_latency)
+        log.info("seeded %d users in %.1fs", self.mock.size, time.perf_counter() - start)
+        self.config_file = standins.write_config(self.directory, self.mock, async_ldap=config.async_ldap)
+        os.environ['CONFIG_FILE'] = self.config_file
+        standins.install_config(self.mock, self.config_file)
+        snapshot = MyConfig.snapshot(self.config_file)
+        self.images = list(snapshot.image_config.allowed_images())
+        if config.preload:
+            stats = snapshot.ad_user.preload()
+            log.info("preloaded %s", stats)
+        self.oidc = OidcServer(latency=config.http_latency).start()
+        self.auth = MyOAuth(discovery_url=self.oidc.discovery_url,
+                            discovery_cache_file='',
+                            client_id=self.oidc.client_id,
+                            client_secret='bench',
+                            oauth_callback_url='https://hub.bench.local/hub/oauth_callback',
+                            username_claim='preferred_username',
+                            scope=['openid', 'profile', 'email', 'groups'],
+                            allowed_groups=['group1', 'group2', 'admins'],
+                            admin_groups=['admins'],
+                            verify_id_token=config.verify_id_token)
+        self.auth._group_mapper = TimedGroupMapping(self.auth.group_mapper)
+
+    def close(self):
+        if self.oidc is not None:
+            self.oidc.stop()
+        MyConfig.snapshot(self.config_file).close()
+
+    def server_names(self, user_index: int) -> list[str]:
+        """
+        the servers a user starts: the default server, or named servers for named_fraction of the users
+        """
+        names = []
+        named = self.rng.random() < self.config.named_fraction
+        for j in range(self.config.servers_per_user):
+            names.append(f'server-{j}' if named or j > 0 else '')
+        return names
+
+    async def monitor_loop(self, interval: float = 0.01):
+        """
+        sleep interval seconds again and again, and record how much later than asked the loop woke up
+        """
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.stats.loop_lag.append(max(0.0, time.perf_counter() - start - interval))
+
+    async def timed(self, phase: str, awaitable):
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        except Exception as e:
+            self.stats.failed(phase, e)
+            raise
+        finally:
+            self.stats.phases[phase].append(time.perf_counter() - start)
+
+    async def user(self, i: int, arrival: float, t0: float):
+        await asyncio.sleep(max(0.0, t0 + arrival - time.perf_counter()))
+        arrived = time.perf_counter()
+        self.stats.arrival_lag.append(arrived - t0 - arrival)
+        username = MockDirectory.username(i)
+        # every user runs in a task of its own, with its own context
+        spent = []
+        _group_seconds.set(spent)
+        try:
+            auth_model = await self.timed('authenticate', self.auth.authenticate(FakeHandler(username)))
+            allowed = await self.timed('authorize', self.authorize(auth_model))
+        except Exception:
+            return
+        if not allowed:
+            self.stats.failed('authorize', PermissionError(f"{username} is not allowed"))
+            return
+        self.stats.phases['groups'].append(sum(spent))
+        self.stats.phases['login'].append(time.perf_counter() - arrived)
+        self.stats.logins += 1
+        user = FakeUser(auth_model['name'], [FakeGroup(name) for name in auth_model.get('groups') or []])
+        await asyncio.gather(*(self.spawn(user, name, arrived) for name in self.server_names(i)))
+
+    async def authorize(self, auth_model: dict) -> bool:
+        username = auth_model['name']
+        return self.auth.check_blocked_users(username, auth_model) and \
+            await self.auth.check_allowed(username, auth_model)
+
+    async def spawn(self, user: FakeUser, name: str, arrived: float):
+        image = self.images[self.rng.randrange(len(self.images))] if self.images else None
+        spawner = FakeSpawner(user, user_options={'image': image} if image else {}, name=name,
+                              start_latency=self.config.start_latency * self.rng.uniform(0.5, 1.5))
+        queued = time.perf_counter()
+        async with self.spawn_slots:
+            self.stats.phases['queue'].append(time.perf_counter() - queued)
+            started = time.perf_counter()
+            try:
+                await self.timed('pre_spawn_hook', my_pre_spawn_hook_async(spawner))
+                await self.timed('start', spawner.start())
+            except Exception:
+                return
+            self.stats.phases['spawn'].append(time.perf_counter() - started)
+        self.stats.phases['total'].append(time.perf_counter() - arrived)
+        self.stats.spawns += 1
+
+    async def run(self) -> float:
+        """
+        run the storm, return the wall time in seconds
+        """
+        config = self.config
+        self.spawn_slots = asyncio.Semaphore(config.spawn_limit)
+        # the discovery document is cached when the hub runs, see MyOAuth.discover
+        await self.auth.discover()
+        arrivals = arrival_times(config.arrival, config.users, config.duration, self.rng)
+        monitor = asyncio.ensure_future(self.monitor_loop())
+        t0 = time.perf_counter()
+        try:
+            await asyncio.gather(*(self.user(i, arrival, t0) for i, arrival in enumerate(arrivals)))
+        finally:
+            monitor.cancel()
+        return time.perf_counter() - t0
+
+    def report(self, seconds: float) -> dict:
+        stats = self.stats
+        snapshot = MyConfig.snapshot(self.config_file)
+        cache = snapshot.ad_user.cache
+        return {
+            'seconds': round(seconds, 3),
+            'logins': stats.logins,
+            'spawns': stats.spawns,
+            'logins_per_second': round(stats.logins / seconds, 2) if seconds > 0 else 0.0,
+            'spawns_per_second': round(stats.spawns / seconds, 2) if seconds > 0 else 0.0,
+            'errors': stats.errors,
+            'phases': {phase: summary(samples) for phase, samples in stats.phases.items()},
+            'loop_lag': summary(stats.loop_lag),
+            'arrival_lag': summary(stats.arrival_lag),
+            'oidc_requests': dict(self.oidc.hits),
+            'memory_cache': cache.stats() if cache is not None else None,
+            'ldap_connections': {state: LdapPool.count(state) for state in ('in_use', 'idle')},
+        }
+
+
+def main(argv: list[str] = None):
+    defaults = StormConfig()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=defaults.users, help='users logging in')
+    parser.add_argument('--arrival', choices=ARRIVALS, default=defaults.arrival)
+    parser.add_argument('--duration', type=float, default=defaults.duration,
+                        help='seconds over which the users arrive (ramp, poisson)')
+    parser.add_argument('--size', type=int, default=defaults.size, help='users in the directory')
+    parser.add_argument('--named-fraction', type=float, default=defaults.named_fraction,
+                        help='fraction of the users which start named servers')
+    parser.add_argument('--servers-per-user', type=int, default=defaults.servers_per_user)
+    parser.add_argument('--spawn-limit', type=int, default=defaults.spawn_limit,
+                        help="concurrent spawns, like JupyterHub's concurrent_spawn_limit")
+    parser.add_argument('--ldap-latency', type=float, default=0, help='milliseconds added to every LDAP search')
+    parser.add_argument('--http-latency', type=float, default=0, help='milliseconds added to every OIDC request')
+    parser.add_argument('--start-latency', type=float, default=0,
+                        help='mean milliseconds of a server start, each start takes 0.5 to 1.5 times of it')
+    parser.add_argument('--verify-id-token', action='store_true', help='read the user from the ID token')
+    parser.add_argument('--preload', action='store_true', help='fill the caches before the storm')
+    parser.add_argument('--async-ldap', action='store_true',
+                        help='search AD on the event loop (ad.async_ldap), the mock then adds no LDAP latency')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--label', default=None, help='stored with the report, e.g. the version under test')
+    parser.add_argument('--output', default=None, help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    config = StormConfig(users=args.users, arrival=args.arrival, duration=args.duration, size=args.size,
+                         named_fraction=args.named_fraction, servers_per_user=args.servers_per_user,
+                         spawn_limit=args.spawn_limit, ldap_latency=args.ldap_latency / 1000,
+                         http_latency=args.http_latency / 1000, start_latency=args.start_latency / 1000,
+                         verify_id_token=args.verify_id_token, preload=args.preload,
+                         async_ldap=args.async_ldap, seed=args.seed)
+    with tempfile.TemporaryDirectory(prefix='login-storm-') as directory:
+        storm = LoginStorm(config, directory)
+        storm.setup()
+        try:
+            seconds = asyncio.run(storm.run())
+            result = storm.report(seconds)
+        finally:
+            storm.close()
+    report = {
+        'label': args.label,
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'platform': platform.platform(),
+        'versions': versions(),
+        'args': {key: value for key, value in vars(args).items() if key != 'output'},
+        'result': result,
+    }
+    phases = result['phases']
+    print(f"{'phase':<16} {'count':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10}", file=sys.stderr)
+    for name, values in list(phases.items()) + [('loop_lag', result['loop_lag'])]:
+        print(f"{name:<16} {values['count']:>6} {values['p50_ms']:>10.3f} {values['p95_ms']:>10.3f} "
+              f"{values['p99_ms']:>10.3f} {values['max_ms']:>10.3f}", file=sys.stderr)
+    print(f"{result['logins']} logins, {result['spawns']} spawns in {result['seconds']}s, errors: {result['errors']}",
+          file=sys.stderr)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+"""
+Benchmarks of the login and spawn path against the local stand-ins of standins.py.
+
+    python src/bench/spawn_path.py --sizes 1000,10000 --concurrency 1,8,32 --output before.json
+    python src/bench/spawn_path.py --sizes 1000,10000 --concurrency 1,8,32 --compare before.json
+
+Every case reports p50/p95/p99 latency in milliseconds and the throughput in operations per second.
+"""
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from importlib import metadata
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Awaitable, Callable
+
+import standins
+from standins import FakeGroup, FakeHandler, FakeSpawner, FakeUser, MockDirectory, OidcServer
+
+from MyConfig import MyConfig, my_pre_spawn_hook, my_pre_spawn_hook_async
+from MyOAuth import MyOAuth
+
+log = logging.getLogger('JupyterHub.bench')
+
+PACKAGES = ('jupyterhub', 'oauthenticator', 'dockerspawner', 'ldap3', 'PyJWT', 'tornado', 'PyYAML')
+
+
+@dataclass
+class Result:
+    case: str
+    # users in the directory, None for the cases which do not depend on it
+    size: int | None
+    concurrency: int
+    iterations: int
+    errors: int
+    seconds: float
+    throughput: float
+    mean_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+
+    @classmethod
+    def from_samples(cls, case: str, size: int | None, concurrency: int, samples: list[float], errors: int,
+                     seconds: float) -> Result:
+        samples = sorted(samples)
+        count = len(samples)
+        return cls(case=case, size=size, concurrency=concurrency, iterations=count, errors=errors,
+                   seconds=round(seconds, 6),
+                   throughput=round(count / seconds, 2) if seconds > 0 else 0.0,
+                   mean_ms=round(1000 * sum(samples) / count, 4) if count else 0.0,
+                   p50_ms=round(1000 * percentile(samples, 50), 4),
+                   p95_ms=round(1000 * percentile(samples, 95), 4),
+                   p99_ms=round(1000 * percentile(samples, 99), 4),
+                   max_ms=round(1000 * samples[-1], 4) if count else 0.0)
+
+    def __str__(self) -> str:
+        size = '-' if self.size is None else self.size
+        return (f"{self.case:<32} {size:>8} {self.concurrency:>4} {self.p50_ms:>10.3f} {self.p95_ms:>10.3f} "
+                f"{self.p99_ms:>10.3f} {self.throughput:>10.1f} {self.errors:>6}")
+
+
+HEADER = f"{'case':<32} {'size':>8} {'conc':>4} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'ops/s':>10} {'errors':>6}"
+
+
+def percentile(samples: list[float], q: float) -> float:
+    """
+    the nearest-rank percentile q of sorted samples
+    """
+    if not samples:
+        return 0.0
+    rank = max(1, -(-len(samples) * q // 100))
+    return samples[int(rank) - 1]
+
+
+def run_threads(fn: Callable[[int], object], iterations: int, concurrency: int) -> tuple[list[float], int, float]:
+    """
+    call fn(i) for i in range(iterations) on concurrency threads.\n
+    Return the duration of every call, the number of calls which raised and the wall time.
+    """
+    def call(i: int) -> tuple[float, bool]:
+        start = time.perf_counter()
+        try:
+            fn(i)
+            ok = True
+        except Exception as e:
+            log.debug("call %d failed: %s", i, e)
+            ok = False
+        return time.perf_counter() - start, ok
+
+    if concurrency <= 1:
+        start = time.perf_counter()
+        results = [call(i) for i in range(iterations)]
+        seconds = time.perf_counter() - start
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bench') as executor:
+            # the threads are started before the clock
+            barrier = threading.Barrier(concurrency)
+            list(executor.map(lambda _: barrier.wait(), range(concurrency)))
+            start = time.perf_counter()
+            results = list(executor.map(call, range(iterations)))
+            seconds = time.perf_counter() - start
+    return [duration for duration, _ in results], sum(1 for _, ok in results if not ok), seconds
+
+
+async def run_tasks(fn: Callable[[int], Awaitable], iterations: int, concurrency: int) -> tuple[list[float], int, float]:
+    """
+    await fn(i) for i in range(iterations), at most concurrency at a time, see run_threads
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(i: int) -> tuple[float, bool]:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await fn(i)
+                ok = True
+            except Exception as e:
+                log.debug("call %d failed: %s", i, e)
+                ok = False
+            return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(call(i) for i in range(iterations)))
+    seconds = time.perf_counter() - start
+    return [duration for duration, _ in results], sum(1 for _, ok in results if not ok), seconds
+
+
+class SpawnPathBench:
+    """
+    runs the cases at every directory size and concurrency level, in a temporary directory
+    """
+
+    def __init__(self, sizes: list[int], concurrency: list[int], iterations: int, ad_iterations: int = 200,
+                 ldap_latency: float = 0, http_latency: float = 0, cases: list[str] = None) -> None:
+        self.sizes = sizes
+        self.concurrency = concurrency
+        self.iterations = iterations
+        # the cases which search the mock directory are slow, see MockDirectory
+        self.ad_iterations = ad_iterations
+        self.ldap_latency = ldap_latency
+        self.http_latency = http_latency
+        self.cases = cases
+        self.results: list[Result] = []
+        self.directory: str = None
+
+    def selected(self, case: str) -> bool:
+        return not self.cases or any(pattern in case for pattern in self.cases)
+
+    def record(self, case: str, size: int | None, concurrency: int, measured: tuple[list[float], int, float]):
+        result = Result.from_samples(case, size, concurrency, *measured)
+        self.results.append(result)
+        print(result, file=sys.stderr, flush=True)
+
+    def run(self) -> list[Result]:
+        print(HEADER, file=sys.stderr)
+        with tempfile.TemporaryDirectory(prefix='spawn-bench-') as directory:
+            self.directory = directory
+            for size in self.sizes:
+                self.run_size(size)
+            self.run_oauth()
+        return self.results
+
+    def db(self, name: str) -> str:
+        return os.path.join(self.directory, f'{name}.sqlite3')
+
+    def run_size(self, size: int):
+        start = time.perf_counter()
+        mock = MockDirectory(size, latency=self.ldap_latency)
+        log.info("seeded %d users in %.1fs", size, time.perf_counter() - start)
+        usernames = mock.usernames()
+        iterations = self.iterations
+
+        if self.selected('my_ad.get_user_info_all'):
+            ad_user = mock.ad_user(self.db(f'all-{size}'))
+
+            def get_user_info_all(i):
+                ad = ad_user.my_ad()
+                try:
+                    return ad.get_user_info_all()
+                finally:
+                    ad.disconnect()
+            self.record('my_ad.get_user_info_all', size, 1, run_threads(get_user_info_all, 3, 1))
+
+        # the local cache filled once, read by the sql and memory cases
+        filled = mock.ad_user(self.db(f'filled-{size}'), cache=False)
+        filled.preload()
+        if self.selected('user_sql.upsert_all'):
+            userinfos = filled.sql.get_all()
+            self.record('user_sql.upsert_all', size, 1, run_threads(lambda i: filled.sql.upsert_all(userinfos), 3, 1))
+
+        if self.selected('user_check_many.ad'):
+            # a roster of ad_iterations users resolved at once, into a new empty local cache every call
+            roster = usernames[:self.ad_iterations]
+
+            def user_check_many(i):
+                cold = mock.ad_user(self.db(f'many-{size}-{i}'), cache=False)
+                try:
+                    return cold.user_check_many(roster)
+                finally:
+                    cold.close()
+            self.record('user_check_many.ad', size, 1, run_threads(user_check_many, 3, 1))
+
+        for concurrency in self.concurrency:
+            if self.selected('user_sql.get_by_username'):
+                def get_by_username(i):
+                    filled.sql.connect()
+                    return filled.sql.get_by_username(random.choice(usernames))
+                self.record('user_sql.get_by_username', size, concurrency,
+                            run_threads(get_by_username, iterations, concurrency))
+
+            if self.selected('user_check.sql'):
+                self.record('user_check.sql', size, concurrency,
+                            run_threads(lambda i: filled.user_check(random.choice(usernames)), iterations, concurrency))
+
+            if self.selected('user_check.memory'):
+                warm = mock.ad_user(self.db(f'filled-{size}'))
+                for username in usernames[:warm.cache_config.max_size]:
+                    warm.user_check(username)
+                hot = usernames[:warm.cache_config.max_size]
+                self.record('user_check.memory', size, concurrency,
+                            run_threads(lambda i: warm.user_check(random.choice(hot)), iterations, concurrency))
+
+            if self.selected('user_check.ad'):
+                # a new empty local cache for every level, every call asks AD for a user it has not seen
+                cold = mock.ad_user(self.db(f'cold-{size}-{concurrency}'), cache=False)
+                self.record('user_check.ad', size, concurrency,
+                            run_threads(lambda i: cold.user_check(usernames[i % size]),
+                                        min(self.ad_iterations, size), concurrency))
+                cold.close()
+
+            if self.selected('user_check.ad_async'):
+                # the same on the event loop, with the asynchronous mock strategy which has no latency
+                cold = mock.ad_user(self.db(f'cold-async-{size}-{concurrency}'), cache=False)
+                self.record('user_check.ad_async', size, concurrency,
+                            asyncio.run(run_tasks(lambda i: cold.user_check_async(usernames[i % size]),
+                                                  min(self.ad_iterations, size), concurrency)))
+                cold.close()
+
+            if self.selected('user_check.missing'):
+                self.record('user_check.missing', size, concurrency,
+                            run_threads(lambda i: filled.user_check(f'nobody{i}'), self.ad_iterations, concurrency))
+
+            if self.selected('pre_spawn_hook'):
+                self.run_hooks(mock, size, concurrency, usernames)
+
+    def run_hooks(self, mock: MockDirectory, size: int, concurrency: int, usernames: list[str]):
+        """
+        the pre-spawn hooks with a config.yaml which reads the users from mock, on a warm memory cache
+        """
+        directory = os.path.join(self.directory, f'hook-{size}-{concurrency}')
+        os.makedirs(directory)
+        config_file = standins.write_config(directory, mock)
+        os.environ['CONFIG_FILE'] = config_file
+        standins.install_config(mock, config_file)
+        snapshot = MyConfig.snapshot(config_file)
+        images = list(snapshot.image_config.allowed_images())
+        users = [FakeUser(username, [FakeGroup('collaborative')] if i % 10 == 0 else [])
+                 for i, username in enumerate(usernames[:snapshot.ad_user.cache_config.max_size])]
+
+        def spawner(i: int) -> FakeSpawner:
+            return FakeSpawner(users[i % len(users)], user_options={'image': images[i % len(images)]})
+
+        for user in users:
+            snapshot.ad_user.user_check(user.name)
+        if self.selected('pre_spawn_hook.sync'):
+            self.record('pre_spawn_hook.sync', size, concurrency,
+                        run_threads(lambda i: my_pre_spawn_hook(spawner(i)), self.iterations, concurrency))
+        if self.selected('pre_spawn_hook.async'):
+            self.record('pre_spawn_hook.async', size, concurrency,
+                        asyncio.run(run_tasks(lambda i: my_pre_spawn_hook_async(spawner(i)), self.iterations, concurrency)))
+        snapshot.close()
+
+    def authenticator(self, oidc: OidcServer, **kwargs) -> MyOAuth:
+        return MyOAuth(discovery_url=oidc.discovery_url,
+                       discovery_cache_file='',
+                       client_id=oidc.client_id,
+                       client_secret='bench',
+                       oauth_callback_url='https://hub.bench.local/hub/oauth_callback',
+                       username_claim='preferred_username',
+                       scope=['openid', 'profile', 'email', 'groups'],
+                       allowed_groups=['group1', 'group2', 'admins'],
+                       **kwargs)
+
+    def run_oauth(self):
+        """
+        the login against the local OpenID Connect service, the discovery document is cached
+        """
+        if not self.selected('oauth'):
+            return
+        with OidcServer(latency=self.http_latency) as oidc:
+            for concurrency in self.concurrency:
+                if self.selected('oauth.pre_auth'):
+                    auth = self.authenticator(oidc)
+                    asyncio.run(auth.discover())
+                    self.record('oauth.pre_auth', None, concurrency,
+                                run_threads(lambda i: auth._pre_auth(), self.iterations, concurrency))
+                for case, kwargs in (('oauth.authenticate.userinfo', {}),
+                                     ('oauth.authenticate.id_token', {'verify_id_token': True})):
+                    if not self.selected(case):
+                        continue
+                    auth = self.authenticator(oidc, **kwargs)
+
+                    async def authenticate_all():
+                        await auth.discover()
+
+                        async def authenticate(i):
+                            auth_model = await auth.authenticate(FakeHandler(MockDirectory.username(i)))
+                            if auth_model is None:
+                                raise ValueError("no auth model")
+                        return await run_tasks(authenticate, self.iterations, concurrency)
+                    self.record(case, None, concurrency, asyncio.run(authenticate_all()))
+
+
+def versions() -> dict[str, str | None]:
+    result = {'python': platform.python_version()}
+    for package in PACKAGES:
+        try:
+            result[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            result[package] = None
+    return result
+
+
+def compare(results: list[dict], baseline: dict):
+    """
+    print the p50 and p95 of results relative to the same cases of a previous run
+    """
+    old = {(r['case'], r['size'], r['concurrency']): r for r in baseline['results']}
+    print(f"{'case':<32} {'size':>8} {'conc':>4} {'p50':>16} {'p95':>16} {'ops/s':>16}", file=sys.stderr)
+    for result in results:
+        before = old.get((result['case'], result['size'], result['concurrency']))
+        if before is None:
+            continue
+        columns = []
+        for name in ('p50_ms', 'p95_ms', 'throughput'):
+            ratio = result[name] / before[name] if before[name] else float('nan')
+            columns.append(f"{result[name]:>9.3f} x{ratio:<5.2f}")
+        size = '-' if result['size'] is None else result['size']
+        print(f"{result['case']:<32} {size:>8} {result['concurrency']:>4} " + ' '.join(columns), file=sys.stderr)
+
+
+def int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int_list, default=[1000, 10000], help='users in the directory, comma separated')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 8, 32], help='concurrent calls, comma separated')
+    parser.add_argument('--iterations', type=int, default=1000, help='calls per case and level')
+    parser.add_argument('--ad-iterations', type=int, default=200,
+                        help='calls per level of the cases which search the directory (user_check.ad, .ad_async, .missing), '
+                             'users of the roster of user_check_many.ad')
+    parser.add_argument('--ldap-latency', type=float, default=0, help='milliseconds added to every synchronous LDAP search')
+    parser.add_argument('--http-latency', type=float, default=0, help='milliseconds added to every OIDC request')
+    parser.add_argument('--cases', type=lambda v: v.split(','), default=None,
+                        help='run only the cases containing one of these names, comma separated')
+    parser.add_argument('--label', default=None, help='stored with the results, e.g. the version under test')
+    parser.add_argument('--output', default=None, help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+    bench = SpawnPathBench(args.sizes, args.concurrency, args.iterations, ad_iterations=args.ad_iterations,
+                           ldap_latency=args.ldap_latency / 1000, http_latency=args.http_latency / 1000,
+                           cases=args.cases)
+    results = [asdict(result) for result in bench.run()]
+    report = {
+        'label': args.label,
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'platform': platform.platform(),
+        'versions': versions(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results,
+    }
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
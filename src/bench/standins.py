@@ -0,0 +1,382 @@
+"""
+Local stand-ins for AD, the OpenID Connect service and the spawner, so the login and spawn path can be
+measured without a domain controller, Keycloak or a Docker daemon.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+CONFIG_SCRIPT_DIR = os.getenv('CONFIG_SCRIPT_DIR', os.path.join(ROOT_DIR, 'src', 'config'))
+if CONFIG_SCRIPT_DIR not in sys.path:
+    sys.path.append(CONFIG_SCRIPT_DIR)
+
+import jwt
+import yaml
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+from ldap3 import Connection, MOCK_ASYNC, MOCK_SYNC, OFFLINE_AD_2012_R2, Server
+from AdUsers import AdUser, AsyncLdapConfig, AsyncLdapPool, LdapConfig, LdapPool, PoolConfig, UserSql
+
+log = logging.getLogger('JupyterHub.bench')
+
+
+def object_sid(rid: int) -> bytes:
+    """
+    the binary objectSid of a user of the domain S-1-5-21-1-2-3 with the relative id rid
+    """
+    return b'\x01\x05\x00\x00\x00\x00\x00\x05' + struct.pack('<5I', 21, 1, 2, 3, rid)
+
+
+class SlowConnection(Connection):
+    """
+    a mock connection which waits latency seconds in every search, like a domain controller over the network
+    """
+    latency: float = 0
+
+    def search(self, *args, **kwargs):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return super().search(*args, **kwargs)
+
+
+class MockDirectory:
+    """
+    An AD of size users in memory, served by ldap3's MOCK_SYNC strategy.\n
+    The connections share the entries of one mock server, so a pool can open as many as it likes.
+    Note that the mock evaluates every filter against all entries, so a single search gets slower with size.
+    """
+    BASE_DN = 'DC=bench,DC=local'
+    USER_BASE_RDN = 'OU=Users'
+    BIND_DN = 'CN=bench,DC=bench,DC=local'
+    BIND_PW = 'bench'
+    FIRST_RID = 1000
+
+    def __init__(self, size: int, latency: float = 0) -> None:
+        self.size = size
+        self.latency = latency
+        self.server = Server('mock', get_info=OFFLINE_AD_2012_R2)
+        self.seed()
+
+    @classmethod
+    def username(cls, i: int) -> str:
+        return f'user{i:06d}'
+
+    def usernames(self) -> list[str]:
+        return [self.username(i) for i in range(self.size)]
+
+    def seed(self):
+        conn = Connection(self.server, user=self.BIND_DN, password=self.BIND_PW, client_strategy=MOCK_SYNC)
+        conn.strategy.add_entry(self.BIND_DN, {'userPassword': self.BIND_PW, 'sn': 'bench'})
+        user_base_dn = f'{self.USER_BASE_RDN},{self.BASE_DN}'
+        for i in range(self.size):
+            username = self.username(i)
+            conn.strategy.add_entry(f'CN={username},{user_base_dn}', {
+                'sAMAccountName': username,
+                'objectClass': ['top', 'person', 'user'],
+                'objectSid': object_sid(self.FIRST_RID + i),
+                'cn': username,
+                'mail': f'{username}@bench.local',
+            })
+
+    def connect(self) -> Connection:
+        """
+        a new bound connection, the factory of the pool
+        """
+        conn = SlowConnection(self.server, user=self.BIND_DN, password=self.BIND_PW, client_strategy=MOCK_SYNC)
+        conn.latency = self.latency
+        conn.bind()
+        return conn
+
+    def connect_async(self) -> Connection:
+        """
+        a new bound connection with the asynchronous mock strategy, the factory of the AsyncLdapPool.
+        The mock answers every search at once, latency is not added.
+        """
+        conn = Connection(self.server, user=self.BIND_DN, password=self.BIND_PW, client_strategy=MOCK_ASYNC)
+        conn.bind()
+        return conn
+
+    def ldap_config(self) -> LdapConfig:
+        ldap_config = LdapConfig()
+        ldap_config.HOST = 'mock'
+        ldap_config.BASE_DN = self.BASE_DN
+        ldap_config.BIND_DN = self.BIND_DN
+        ldap_config.BIND_PW = self.BIND_PW
+        ldap_config.USER_BASE_RDN = self.USER_BASE_RDN
+        ldap_config.USER_FILTER = '(objectClass=person)'
+        ldap_config.USERNAME_ATTRIBUTE = 'sAMAccountName'
+        return ldap_config
+
+    def install(self, ldap_config: LdapConfig = None, pool_config: PoolConfig = None,
+                async_config: AsyncLdapConfig = None) -> LdapPool:
+        """
+        make LdapPool.get and AsyncLdapPool.get return pools of this directory for ldap_config, so code which
+        builds its AdUser from config.yaml (the pre-spawn hook) talks to the mock
+        """
+        if ldap_config is None:
+            ldap_config = self.ldap_config()
+        if pool_config is None:
+            pool_config = PoolConfig()
+        if async_config is None:
+            async_config = AsyncLdapConfig()
+        pool = LdapPool(ldap_config, pool_config, factory=self.connect)
+        async_pool = AsyncLdapPool(ldap_config, async_config, factory=self.connect_async)
+        key = (ldap_config.SERVER_URL, ldap_config.BIND_DN, ldap_config.BIND_PW)
+        for cls, new_pool in ((LdapPool, pool), (AsyncLdapPool, async_pool)):
+            with cls._pools_lock:
+                old_pool = cls._pools.get(key)
+                cls._pools[key] = new_pool
+            if old_pool is not None:
+                old_pool.close()
+        return pool
+
+    def ad_user(self, db: str, cache: bool = True, pool_config: PoolConfig = None) -> AdUser:
+        """
+        an AdUser of this directory with its local cache in the sqlite file db
+        """
+        ldap_config = self.ldap_config()
+        user_sql = UserSql(db)
+        user_sql.table = 'ad_cache'
+        ad_user = AdUser(ldap_config, user_sql, start_uid=1615200000)
+        ad_user.pool_config = pool_config
+        ad_user.cache_config.enable = cache
+        self.install(ldap_config, pool_config, ad_user.async_config)
+        return ad_user
+
+
+def write_config(directory: str, mock: MockDirectory = None, db: str = None, template: str = None,
+                 async_ldap: bool = False) -> str:
+    """
+    write a config.yaml to directory, based on the example config of the repository, which reads the users from
+    mock. Without mock, AD is disabled. Return the path of the file.
+    """
+    if template is None:
+        template = os.path.join(ROOT_DIR, 'config', 'config.yaml')
+    with open(template) as f:
+        config = yaml.safe_load(f)
+    ad = config['ad']
+    if mock is None:
+        ad['enable'] = False
+    else:
+        ad['enable'] = True
+        ad.pop('allow_users', None)
+        ad['config'].update({
+            'host': 'mock',
+            'base_dn': mock.BASE_DN,
+            'bind_dn': mock.BIND_DN,
+            'bind_pw': mock.BIND_PW,
+            'user_search_rdn': mock.USER_BASE_RDN,
+            'user_search_filter': '(objectClass=person)',
+            'user_username_attribute': 'sAMAccountName',
+        })
+        ad['config'].pop('schema_cache', None)
+        ad['local_cache']['connect'] = db if db is not None else os.path.join(directory, 'ad_cache.sqlite3')
+        # nothing runs in the background of a benchmark
+        ad['sync']['enable'] = False
+        ad['preload']['enable'] = False
+        ad.setdefault('async_ldap', {})['enable'] = async_ldap
+    config['user_update']['enable'] = True
+    config['user_update']['from_ad'] = mock is not None
+    filename = os.path.join(directory, 'config.yaml')
+    with open(filename, 'w') as f:
+        yaml.safe_dump(config, f)
+    return filename
+
+
+def install_config(mock: MockDirectory, filename: str):
+    """
+    point the snapshot of filename, which MyConfig.snapshot builds from config.yaml, at mock
+    """
+    from MyConfig import MyConfig
+    ad_user = MyConfig.snapshot(filename).ad_user
+    if ad_user is not None:
+        mock.install(ad_user.ldap_config, ad_user.pool_config, ad_user.async_config)
+
+
+def default_groups(username: str) -> list[str]:
+    """
+    Keycloak group paths, spread over a few teams and projects
+    """
+    i = sum(username.encode())
+    return [f'/org/team{i % 10}', f'/projects/p{i % 7}', '/group1']
+
+
+class OidcServer:
+    """
+    A local OpenID Connect service, in a thread, which serves the discovery document, the token and userinfo
+    endpoints and the JWKS.\n
+    The code of the token request is the username, the access token is 'at-' + username. The ID token is signed
+    with an RSA key of the server. Every response waits latency seconds first.
+    """
+
+    def __init__(self, latency: float = 0, client_id: str = 'bench', groups=default_groups) -> None:
+        self.latency = latency
+        self.client_id = client_id
+        self.groups = groups
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.hits: collections.Counter[str] = collections.Counter()
+        self._lock = threading.Lock()
+        self._httpd: ThreadingHTTPServer = None
+        self._thread: threading.Thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._httpd.server_port}'
+
+    @property
+    def discovery_url(self) -> str:
+        return self.url + '/.well-known/openid-configuration'
+
+    def start(self) -> OidcServer:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.handle(self, 'GET')
+
+            def do_POST(self):
+                server.handle(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='bench-oidc', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self) -> OidcServer:
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def discovery(self) -> dict:
+        return {
+            'issuer': self.url,
+            'authorization_endpoint': self.url + '/auth',
+            'token_endpoint': self.url + '/token',
+            'userinfo_endpoint': self.url + '/userinfo',
+            'end_session_endpoint': self.url + '/logout',
+            'jwks_uri': self.url + '/jwks',
+        }
+
+    def claims(self, username: str) -> dict:
+        return {
+            'sub': username,
+            'preferred_username': username,
+            'email': f'{username}@bench.local',
+            'groups': self.groups(username),
+        }
+
+    def id_token(self, username: str) -> str:
+        now = int(time.time())
+        claims = dict(self.claims(username), iss=self.url, aud=self.client_id, iat=now, exp=now + 300)
+        return jwt.encode(claims, self.key, algorithm='RS256', headers={'kid': 'bench'})
+
+    def jwks(self) -> dict:
+        key = json.loads(RSAAlgorithm.to_jwk(self.key.public_key()))
+        key.update(kid='bench', use='sig', alg='RS256')
+        return {'keys': [key]}
+
+    def handle(self, request: BaseHTTPRequestHandler, method: str):
+        path = urlparse(request.path).path
+        with self._lock:
+            self.hits[path] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        body = None
+        if method == 'POST' and path == '/token':
+            length = int(request.headers.get('Content-Length', 0))
+            params = parse_qs(request.rfile.read(length).decode())
+            username = params.get('code', [''])[0]
+            body = {'access_token': 'at-' + username, 'token_type': 'Bearer', 'expires_in': 300,
+                    'id_token': self.id_token(username), 'scope': 'openid profile email groups'}
+        elif method == 'GET' and path == '/.well-known/openid-configuration':
+            body = self.discovery()
+        elif method == 'GET' and path == '/userinfo':
+            token = request.headers.get('Authorization', '').split(' ')[-1]
+            if token.startswith('at-'):
+                body = self.claims(token[3:])
+        elif method == 'GET' and path == '/jwks':
+            body = self.jwks()
+        data = json.dumps(body if body is not None else {'error': 'not_found'}).encode()
+        request.send_response(200 if body is not None else 404)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+
+@dataclass
+class FakeRequest:
+    protocol: str = 'https'
+    host: str = 'hub.bench.local'
+
+
+class FakeHandler:
+    """
+    the request handler of an OAuth callback with ?code=code, as far as OAuthenticator.authenticate uses it
+    """
+
+    def __init__(self, code: str) -> None:
+        self.code = code
+        self.request = FakeRequest()
+
+    def get_argument(self, name: str, default=None):
+        return self.code if name == 'code' else default
+
+
+@dataclass
+class FakeGroup:
+    name: str
+
+
+@dataclass
+class FakeUser:
+    name: str
+    groups: list[FakeGroup] = field(default_factory=list)
+
+
+class FakeSpawner:
+    """
+    the attributes of a DockerSpawner which the pre-spawn hook reads and writes.\n
+    start() waits start_latency seconds instead of creating a container.
+    """
+
+    def __init__(self, user: FakeUser, image: str = 'jupyter/minimal-notebook', user_options: dict = None,
+                 name: str = '', start_latency: float = 0) -> None:
+        self.user = user
+        self.name = name
+        self.image = image
+        self.user_options = user_options if user_options is not None else {}
+        self.environment = {}
+        self.extra_create_kwargs = {'hostname': '{username}-{servername}'}
+        self.args = []
+        self.log = log
+        self.start_latency = start_latency
+
+    async def start(self) -> tuple[str, int]:
+        await asyncio.sleep(self.start_latency)
+        return '127.0.0.1', 8888
@@ -0,0 +1,171 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Callable
+from AdUsers import AdUser, SyncConfig, SyncStats
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+
+@dataclass
+class SyncStatus:
+    running: bool = False
+    # time.time() of the start and end of the last sync
+    last_start: float = None
+    last_end: float = None
+    last_success: float = None
+    last_error: str = None
+    last_result: str = None
+    last_rows: int = 0
+    last_seconds: float = 0
+    syncs: int = 0
+    failures: int = 0
+    # the preload at startup
+    preload_rows: int = 0
+    preload_seconds: float = 0
+    preload_end: float = None
+    preload_error: str = None
+
+
+class AdSyncService:
+    """
+    Keep the local AD cache up to date in the background of the hub.\n
+    It runs AdUser.user_sync_delta (or user_sync) every sync_config.interval seconds on a thread of its own,
+    so that user_check finds every user in the local cache and spawns do not wait for AD.
+    If preload_config.enable is set, the allowed users are loaded once first, see AdUser.preload.
+    """
+
+    def __init__(self, get_ad_user: Callable[[], AdUser], log: logging.Logger = None) -> None:
+        # get_ad_user is called before every sync, so that changes of config.yaml are used
+        self.get_ad_user = get_ad_user
+        self.log = log or logging.getLogger('JupyterHub.ad_sync')
+        self.status = SyncStatus()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ad-sync')
+        self._task: asyncio.Task = None
+
+    def start(self) -> bool:
+        """
+        start the periodic sync on the running event loop. Return False if there is no running loop.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.log.warning("No running event loop, the AD sync is not started")
+            return False
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        return True
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        # the last sync config read, its interval is waited after an error
+        sync_config = SyncConfig()
+        # the preload is retried until it succeeded, the syncs start after it
+        preloaded = False
+        delay = 0
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                ad_user = self.get_ad_user()
+                if ad_user is not None:
+                    sync_config = ad_user.sync_config
+                if not preloaded and ad_user is not None:
+                    if ad_user.preload_config.enable and await self.preload(ad_user) is None:
+                        delay = sync_config.interval
+                    else:
+                        preloaded = True
+                        delay = random.uniform(0, sync_config.jitter)
+                elif ad_user is not None and sync_config.enable:
+                    await self.sync(ad_user)
+                    delay = sync_config.interval + random.uniform(0, sync_config.jitter)
+                else:
+                    # AD or the sync is disabled, check config.yaml again later
+                    delay = 60
+            except Exception as e:
+                # e.g. a broken config.yaml, the sync must go on once it is fixed
+                self.status.failures += 1
+                self.status.last_error = f"{type(e).__name__}: {e}"
+                self.log.error("AD sync failed: %s", self.status.last_error)
+                self.write_status(sync_config.status_file)
+                delay = sync_config.interval
+
+    async def sync(self, ad_user: AdUser) -> SyncStats | None:
+        """
+        run one sync on the sync thread and update the status
+        """
+        loop = asyncio.get_running_loop()
+        sync_config = ad_user.sync_config
+        method = ad_user.user_sync if sync_config.mode == 'full' else ad_user.user_sync_delta
+        self.status.running = True
+        self.status.last_start = time.time()
+        try:
+            stats: SyncStats = await loop.run_in_executor(self._executor, method)
+        except Exception as e:
+            self.status.failures += 1
+            self.status.last_error = f"{type(e).__name__}: {e}"
+            self.log.error("AD sync failed: %s", self.status.last_error)
+            stats = None
+        else:
+            self.status.last_success = time.time()
+            self.status.last_error = None
+            self.status.last_result = str(stats)
+            self.status.last_rows = stats.rows
+            self.status.last_seconds = stats.seconds
+            self.log.info("AD %s", stats)
+        finally:
+            self.status.running = False
+            self.status.last_end = time.time()
+            self.status.syncs += 1
+        self.write_status(sync_config.status_file)
+        return stats
+
+    async def preload(self, ad_user: AdUser) -> SyncStats | None:
+        """
+        run AdUser.preload on the sync thread, logging its progress
+        """
+        loop = asyncio.get_running_loop()
+
+        def progress(rows: int, seconds: float):
+            self.log.info("AD preload: %d users in %.1fs", rows, seconds)
+
+        self.status.running = True
+        try:
+            stats: SyncStats = await loop.run_in_executor(self._executor, ad_user.preload, progress)
+        except Exception as e:
+            self.status.preload_error = f"{type(e).__name__}: {e}"
+            self.log.error("AD preload failed: %s", self.status.preload_error)
+            stats = None
+        else:
+            self.status.preload_error = None
+            self.status.preload_rows = stats.rows
+            self.status.preload_seconds = stats.seconds
+            self.log.info("AD %s", stats)
+        finally:
+            self.status.running = False
+            self.status.preload_end = time.time()
+        self.write_status(ad_user.sync_config.status_file)
+        return stats
+
+    def status_dict(self) -> dict:
+        return asdict(self.status)
+
+    def write_status(self, filename: str = None):
+        """
+        write the status as json to filename
+        """
+        if filename is None:
+            return
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(self.status_dict(), f, indent=2)
+            os.replace(filename + '.tmp', filename)
+        except OSError as e:
+            self.log.warning("Cannot write AD sync status to %s: %s", filename, e)
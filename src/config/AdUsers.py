@@ -1,7 +1,29 @@
-from dataclasses import dataclass, fields
-from ldap3 import Server, Connection, ALL, SUBTREE
+from collections import OrderedDict, deque
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, fields, replace
+from ldap3 import Server, Connection, ALL, ASYNC, BASE, NONE, SUBTREE, SYNC
+from ldap3.core.exceptions import (LDAPException, LDAPCommunicationError, LDAPResponseTimeoutError,
+                                   LDAPSessionTerminatedByServerError)
+from ldap3.core.results import RESULT_NO_SUCH_OBJECT, RESULT_SUCCESS
+from ldap3.protocol.formatters.formatters import format_sid
+from ldap3.utils.conv import escape_filter_chars
+from ldap3.protocol.rfc4512 import DsaInfo, SchemaInfo
+import json
+import logging
+import os
+import re
 import sqlite3
+import itertools
+import threading
+import time
+from typing import Callable, Iterable, Iterator
+from Metrics import (AD_SYNC_SECONDS, LDAP_POOL_CONNECTIONS, LDAP_POOL_WAIT_SECONDS, LDAP_SEARCH_SECONDS,
+                     USER_CHECK_SECONDS, USER_SQL_SECONDS, timed)
+from SingleFlight import AsyncSingleFlight, SingleFlight
 
+log = logging.getLogger('JupyterHub.ad_user')
 
 @dataclass
 class UserInfo:
@@ -13,8 +35,16 @@ class UserInfo:
     sid: str = None
     dn: str = None
     mail: str = None
+    # time.time() of the last read from AD, set when the user is written to the local cache
+    refreshed_at: float = None
     # groups: list[str]
 
+    def key(self) -> tuple:
+        """
+        the values that identify this version of the user, refreshed_at excluded
+        """
+        return (self.username, self.groupname, self.cn, self.uid, self.gid, self.sid, self.dn, self.mail)
+
 
 @dataclass
 class LdapConfig:
@@ -27,6 +57,12 @@ class LdapConfig:
     GROUP_BASE_RDN: str = None
     USER_FILTER: str = '(cn=*)'
     GROUP_FILTER: str = '(cn=*)'
+    # directory to store the server's schema and DSA info, None to download them on connect
+    SCHEMA_CACHE_DIR: str = None
+    # download the schema again even if a stored copy exists
+    SCHEMA_REFRESH: bool = False
+    # entries per page when listing the whole directory
+    PAGE_SIZE: int = 500
     TLS = False
     USERNAME_ATTRIBUTE = 'uid'
     GROUPNAME_ATTRIBUTE = 'ou'
@@ -49,7 +85,8 @@ class LdapConfig:
         return self.get_dn_by_rdn(self.GROUP_BASE_RDN)
 
     def USER_BASIC_FILTER(self, username: str) -> str:
-        return '({USERNAME_ATTRIBUTE}={username})'.format(username=username, USERNAME_ATTRIBUTE=self.USERNAME_ATTRIBUTE)
+        # a name like "a*" or "a)(cn=*" must not change the filter
+        return '({USERNAME_ATTRIBUTE}={username})'.format(username=escape_filter_chars(username), USERNAME_ATTRIBUTE=self.USERNAME_ATTRIBUTE)
 
     def GROUP_BASIC_FILTER(self, groupname: str) -> str:
         return '({GROUPNAME_ATTRIBUTE}={groupname})'.format(GROUPNAME_ATTRIBUTE=self.GROUPNAME_ATTRIBUTE, groupname=groupname)
@@ -86,25 +123,305 @@ class LdapConfig:
     def get_group_dn_ou(cls, groupname: str, ou_dn: str, GROUPNAME_ATTRIBUTE: str = 'cn'):
         return '{GROUPNAME_ATTRIBUTE}={groupname},{OU_DN}'.format(GROUPNAME_ATTRIBUTE=GROUPNAME_ATTRIBUTE, groupname=groupname, OU_DN=ou_dn)
 
-    def server(self) -> Server:
+    def server(self, refresh: bool = False) -> Server:
+        """
+        return the server. With SCHEMA_CACHE_DIR, the stored schema and DSA info is used and nothing is downloaded.
+        """
+        if self.SCHEMA_CACHE_DIR is not None and not (refresh or self.SCHEMA_REFRESH):
+            server = LdapSchemaCache(self.SCHEMA_CACHE_DIR).load_server(self)
+            if server is not None:
+                return server
         return Server(host=self.HOST, port=self.PORT, use_ssl=self.TLS, get_info=ALL)
 
-    def connect(self) -> Connection:
+    def connect(self, server: Server = None, client_strategy=SYNC) -> Connection:
         if self.BIND_DN is None:
             raise ValueError("BIND_DN is None")
         elif self.BIND_PW is None:
             raise ValueError("BIND_PW is None")
+        if server is None:
+            server = self.server()
+        conn = Connection(server, self.BIND_DN, self.BIND_PW, auto_bind=True, client_strategy=client_strategy)
+        if server.get_info != NONE and server.schema is not None:
+            # schema and info were read while binding, other connections to this server can skip it
+            if self.SCHEMA_CACHE_DIR is not None:
+                LdapSchemaCache(self.SCHEMA_CACHE_DIR).save(self, server)
+            server.get_info = NONE
+        return conn
+
+    def open_server(self) -> tuple[Server, Connection]:
+        """
+        return the server and a first connection to it. A stored schema older than the server's is downloaded again.
+        """
         server = self.server()
-        return Connection(server, self.BIND_DN, self.BIND_PW, auto_bind=True)
+        conn = self.connect(server)
+        if self.SCHEMA_CACHE_DIR is not None and LdapSchemaCache.outdated(conn):
+            conn.unbind()
+            server = self.server(refresh=True)
+            conn = self.connect(server)
+        return server, conn
+
+
+class LdapSchemaCache:
+    """
+    The schema and DSA info of LDAP servers, stored as json files in a directory.\n
+    The files are named after the server and the schema's modifyTimestamp, <host>_<port>.json points to the current ones.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    @classmethod
+    def _name(cls, *parts) -> str:
+        return re.sub(r'[^A-Za-z0-9.-]+', '_', '_'.join(str(part) for part in parts))
+
+    @classmethod
+    def schema_version(cls, schema: SchemaInfo) -> str:
+        stamp = schema.modify_time_stamp
+        if isinstance(stamp, list):
+            stamp = stamp[0] if stamp else None
+        return str(stamp) if stamp is not None else None
+
+    def _index_file(self, ldap_config: LdapConfig) -> str:
+        return os.path.join(self.directory, self._name(ldap_config.HOST, ldap_config.PORT) + '.json')
+
+    def load_server(self, ldap_config: LdapConfig) -> Server:
+        """
+        return a server with the stored schema and info, None if nothing is stored
+        """
+        try:
+            with open(self._index_file(ldap_config)) as f:
+                index = json.load(f)
+            info = DsaInfo.from_file(os.path.join(self.directory, index['info']))
+            schema = SchemaInfo.from_file(os.path.join(self.directory, index['schema']))
+        except (OSError, ValueError, KeyError, LDAPException):
+            return None
+        server = Server.from_definition(ldap_config.HOST, info, schema, port=ldap_config.PORT, use_ssl=ldap_config.TLS)
+        server.get_info = NONE
+        return server
+
+    def save(self, ldap_config: LdapConfig, server: Server):
+        """
+        store the schema and info of server
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        name = self._name(ldap_config.HOST, ldap_config.PORT, self.schema_version(server.schema))
+        index = {'version': self.schema_version(server.schema),
+                 'info': name + '.info.json',
+                 'schema': name + '.schema.json'}
+        server.info.to_file(os.path.join(self.directory, index['info']))
+        server.schema.to_file(os.path.join(self.directory, index['schema']))
+        index_file = self._index_file(ldap_config)
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_file + '.tmp', index_file)
+
+    @classmethod
+    def outdated(cls, conn: Connection) -> bool:
+        """
+        check if the server reports a newer schema than the one of conn.server
+        """
+        schema = conn.server.schema
+        if schema is None or not schema.schema_entry:
+            return False
+        conn.search(schema.schema_entry, '(objectClass=*)', BASE, attributes=['modifyTimestamp'])
+        if len(conn.entries) == 0 or not conn.entries[0].modifyTimestamp.raw_values:
+            return False
+        current = conn.entries[0].modifyTimestamp.raw_values[0]
+        if isinstance(current, bytes):
+            current = current.decode()
+        return current != cls.schema_version(schema)
+
+
+@dataclass
+class PoolConfig:
+    # max number of connections, idle and borrowed
+    max_size: int = 4
+    # seconds an idle connection is kept before it is closed
+    idle_timeout: float = 300
+    # connections idle longer than this are checked with a "who am i" before reuse
+    check_interval: float = 30
+    # seconds to wait for a free connection
+    timeout: float = 10
+
+
+class LdapPool:
+    """
+    Long-lived, bound LDAP connections shared by all MyAD instances of the hub process.\n
+    Use LdapPool.get(ldap_config) to get the pool of a server and bind user.
+    """
+    _pools: dict[tuple, 'LdapPool'] = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, ldap_config: LdapConfig, config: PoolConfig = None, factory=None) -> None:
+        if config is None:
+            config = PoolConfig()
+        self.ldap_config = ldap_config
+        self.config = config
+        # factory() returns a new bound connection
+        self.factory = factory
+        self.server: Server = None
+        self._idle: deque[tuple[Connection, float]] = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(config.max_size)
+        self.size: int = 0
+        self.in_use: int = 0
+
+    @classmethod
+    def count(cls, state: str) -> int:
+        """
+        connections of all pools, in_use or idle
+        """
+        with cls._pools_lock:
+            pools = list(cls._pools.values())
+        if state == 'in_use':
+            return sum(pool.in_use for pool in pools)
+        return sum(len(pool._idle) for pool in pools)
+
+    @classmethod
+    def get(cls, ldap_config: LdapConfig, config: PoolConfig = None) -> 'LdapPool':
+        """
+        return the pool of the server and bind user of ldap_config, create it if not exists
+        """
+        if config is None:
+            config = PoolConfig()
+        key = (ldap_config.SERVER_URL, ldap_config.BIND_DN, ldap_config.BIND_PW)
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None or pool.config != config:
+                if pool is not None:
+                    pool.close()
+                pool = cls(ldap_config, config)
+                cls._pools[key] = pool
+            return pool
+
+    def _open(self) -> Connection:
+        if self.factory is not None:
+            conn = self.factory()
+        elif self.server is None:
+            self.server, conn = self.ldap_config.open_server()
+        else:
+            conn = self.ldap_config.connect(self.server)
+        with self._lock:
+            self.size += 1
+        return conn
+
+    def _close(self, conn: Connection):
+        with self._lock:
+            self.size -= 1
+        try:
+            conn.unbind()
+        except LDAPException:
+            pass
+
+    def _alive(self, conn: Connection, idle: float) -> bool:
+        """
+        check a connection before reuse, rebind it if the server dropped the session
+        """
+        try:
+            if conn.closed or not conn.bound:
+                return conn.bind()
+            if idle > self.config.check_interval:
+                conn.extend.standard.who_am_i()
+            return not conn.closed
+        except LDAPException:
+            try:
+                conn.unbind()
+                return conn.bind()
+            except LDAPException:
+                return False
+
+    def evict_idle(self):
+        """
+        close connections idle longer than idle_timeout
+        """
+        now = time.monotonic()
+        expired: list[Connection] = []
+        with self._lock:
+            while self._idle and now - self._idle[0][1] > self.config.idle_timeout:
+                expired.append(self._idle.popleft()[0])
+        for conn in expired:
+            self._close(conn)
+
+    def acquire(self) -> Connection:
+        """
+        borrow a connection, it must be given back by release()
+        """
+        with timed(LDAP_POOL_WAIT_SECONDS):
+            return self._acquire()
+
+    def _acquire(self) -> Connection:
+        if not self._slots.acquire(timeout=self.config.timeout):
+            raise TimeoutError(f"no free LDAP connection to {self.ldap_config.SERVER_URL} after {self.config.timeout}s")
+        try:
+            self.evict_idle()
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    conn = self._open()
+                    break
+                conn, last_used = item
+                if self._alive(conn, time.monotonic() - last_used):
+                    break
+                self._close(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.in_use += 1
+        return conn
+
+    def release(self, conn: Connection, broken: bool = False):
+        """
+        give back a borrowed connection. A broken connection is closed instead of reused.
+        """
+        with self._lock:
+            self.in_use -= 1
+        if broken or conn.closed:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        with pool.connection() as conn: ...
+        """
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except LDAPCommunicationError:
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken=broken)
+
+    def close(self):
+        """
+        close all idle connections. Borrowed connections are closed when they are released.
+        """
+        with self._lock:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+        for conn in idle:
+            self._close(conn)
+
+
+LDAP_POOL_CONNECTIONS.labels('in_use').set_function(lambda: LdapPool.count('in_use'))
+LDAP_POOL_CONNECTIONS.labels('idle').set_function(lambda: LdapPool.count('idle'))
 
 
 class MyAD:
-    def __init__(self, ad: LdapConfig, base_uid: int = 1615200000) -> None:
+    def __init__(self, ad: LdapConfig, base_uid: int = 1615200000, pool: LdapPool = None) -> None:
         self.__ad_config = ad
         if base_uid is None or isinstance(base_uid, int) is False or base_uid < 0:
             base_uid = 1615200000
         self.base_uid: int = base_uid
         self.__ad: Connection = None
+        self.__pool: LdapPool = pool
         self.force_gid: int = None
         self.force_gname: str = None
 
@@ -116,29 +433,99 @@ class MyAD:
     def ad(self) -> Connection:
         return self.__ad
 
+    @property
+    def pool(self) -> LdapPool:
+        return self.__pool
+
     def connect(self):
         """
-        connect to ldap server. If already connected, do nothing.
+        connect to ldap server. If already connected, do nothing.\n
+        With a pool, the connection is borrowed from it.
         """
         if self.ad is None:
-            self.__ad = self.ad_config.connect()
+            if self.pool is not None:
+                self.__ad = self.pool.acquire()
+            else:
+                self.__ad = self.ad_config.connect()
 
-    def disconnect(self):
+    def disconnect(self, broken: bool = False):
         """
-        disconnect from ldap server. If already disconnected, do nothing.
+        disconnect from ldap server. If already disconnected, do nothing.\n
+        With a pool, the connection is given back to it.
         """
         if self.ad is not None:
-            self.ad.unbind()
+            if self.pool is not None:
+                self.pool.release(self.ad, broken=broken)
+            else:
+                self.ad.unbind()
             self.__ad = None
 
+    def search(self, search_base: str, search_filter: str, attributes: list[str], scope=SUBTREE, **kwargs) -> bool:
+        """
+        search on the current connection. If the connection went stale, reconnect once and search again.
+        """
+        start = time.perf_counter()
+        result = 'error'
+        try:
+            self.connect()
+            try:
+                found = self.ad.search(search_base, search_filter, scope, attributes=attributes, **kwargs)
+            except LDAPCommunicationError:
+                self.disconnect(broken=True)
+                self.connect()
+                found = self.ad.search(search_base, search_filter, scope, attributes=attributes, **kwargs)
+            result = 'ok'
+            return found
+        finally:
+            LDAP_SEARCH_SECONDS.labels(result).observe(time.perf_counter() - start)
+
+    def get_usn(self) -> tuple[str, int]:
+        """
+        get the name of the domain controller (dsServiceName) and its highestCommittedUSN from the root DSE.\n
+        uSNChanged values are only comparable on the same domain controller.
+        LDAPException if the server is not an AD domain controller.
+        """
+        self.search('', '(objectClass=*)', ['dsServiceName', 'highestCommittedUSN'], scope=BASE)
+        if len(self.ad.entries) == 0:
+            raise LDAPException("root DSE not readable")
+        entry = self.ad.entries[0]
+        if 'dsServiceName' not in entry or 'highestCommittedUSN' not in entry or entry.highestCommittedUSN.value is None:
+            raise LDAPException("no highestCommittedUSN in the root DSE")
+        return str(entry.dsServiceName.value), int(entry.highestCommittedUSN.value)
+
+    def iter_user_info_changed(self, usn: int, page_size: int = None) -> Iterator[UserInfo]:
+        """
+        yield the users changed after usn (uSNChanged > usn) on the current domain controller
+        """
+        search_filter = '(&{filter}(uSNChanged>={usn}))'.format(filter=self.ad_config.USER_FILTER or '', usn=usn + 1)
+        return self.iter_user_info(search_filter, page_size=page_size)
+
+    def iter_deleted_sids(self, usn: int, page_size: int = None) -> Iterator[str]:
+        """
+        yield the objectSid of the tombstones created after usn.\n
+        It needs the "show deleted objects" control and the right to list the Deleted Objects container.
+        """
+        if page_size is None:
+            page_size = self.ad_config.PAGE_SIZE
+        self.connect()
+        show_deleted = ('1.2.840.113556.1.4.417', True, None)
+        search_filter = '(&(isDeleted=TRUE)(uSNChanged>={usn}))'.format(usn=usn + 1)
+        entries = self.ad.extend.standard.paged_search(self.ad_config.BASE_DN, search_filter, SUBTREE, attributes=['objectSid'],
+                                                       controls=[show_deleted], paged_size=page_size, generator=True)
+        for entry in entries:
+            if entry.get('type') != 'searchResEntry':
+                continue
+            sid = self._value(entry['attributes'].get('objectSid'))
+            if sid is not None:
+                yield sid
+
     def get_user_sid(self, username: str) -> str:
         """
         get user sid by username.\n
         it search base on USER_BASE_DN and USER_BASIC_FILTER(username)
         """
-        self.connect()
         BASI_USER_FILTER = self.ad_config.USER_BASIC_FILTER(username)
-        self.ad.search(self.ad_config.USER_BASE_DN, BASI_USER_FILTER, SUBTREE, attributes=['objectSid'])
+        self.search(self.ad_config.USER_BASE_DN, BASI_USER_FILTER, attributes=['objectSid'])
         if len(self.ad.entries) == 0:
             return None
         return self.ad.entries[0].objectSid.value
@@ -158,38 +545,113 @@ class MyAD:
         get user info by username.\n
         it search base on USER_BASE_DN and USER_BASIC_FILTER(username)
         """
-        self.connect()
         BASI_USER_FILTER = self.ad_config.USER_BASIC_FILTER(username)
-        self.ad.search(self.ad_config.USER_BASE_DN, BASI_USER_FILTER, SUBTREE, attributes=['objectSid', 'cn', 'mail'])
+        self.search(self.ad_config.USER_BASE_DN, BASI_USER_FILTER, attributes=['objectSid', 'cn', 'mail'])
         if len(self.ad.entries) == 0:
             return None
         entry = self.ad.entries[0]
-        sid = entry.objectSid.value
-        uid = self.sid_to_uid(sid, self.base_uid)
-        cn = entry.cn.value
         mail = entry.mail.value if entry.mail is not None else None
+        return self._user_info(username, entry.objectSid.value, entry.cn.value, entry.entry_dn, mail)
+
+    def _user_info(self, username: str, sid: str, cn: str, dn: str, mail: str) -> UserInfo:
+        uid = self.sid_to_uid(sid, self.base_uid)
         if self.force_gid is None:
             gid = uid
             groupname = username
         else:
             gid = self.force_gid
             groupname = self.force_gname
-        return UserInfo(username=username, groupname=groupname, cn=cn, uid=uid, gid=gid, sid=sid, dn=entry.entry_dn, mail=mail)
+        return UserInfo(username=username, groupname=groupname, cn=cn, uid=uid, gid=gid, sid=sid, dn=dn, mail=mail)
+
+    def iter_user_info(self, search_filter: str = None, page_size: int = None) -> Iterator[UserInfo]:
+        """
+        yield the user info of the users matching search_filter (USER_FILTER by default).\n
+        The directory is read with simple paged results, page_size (PAGE_SIZE by default) entries at a time,
+        so it is not limited by the server's size limit and only one page is held in memory.
+        """
+        if search_filter is None:
+            search_filter = self.ad_config.USER_FILTER
+        if page_size is None:
+            page_size = self.ad_config.PAGE_SIZE
+        username_attr = self.ad_config.USERNAME_ATTRIBUTE
+        self.connect()
+        entries = self.ad.extend.standard.paged_search(self.ad_config.USER_BASE_DN, search_filter, SUBTREE,
+                                                       attributes=['objectSid', 'cn', 'mail', username_attr],
+                                                       paged_size=page_size, generator=True)
+        for entry in entries:
+            if entry.get('type') != 'searchResEntry':
+                continue
+            attributes = entry['attributes']
+            username = self._value(attributes.get(username_attr))
+            sid = self._value(attributes.get('objectSid'))
+            if username is None or sid is None:
+                continue
+            yield self._user_info(username, sid, self._value(attributes.get('cn')), entry['dn'], self._value(attributes.get('mail')))
+
+    def users_filter(self, usernames: Iterable[str]) -> str:
+        """
+        (|(uid=a)(uid=b)...) of usernames, escaped. None if usernames is empty.
+        """
+        usernames = ''.join(self.ad_config.USER_BASIC_FILTER(username) for username in usernames)
+        if len(usernames) == 0:
+            return None
+        return f"(|{usernames})"
+
+    def get_user_info_many(self, usernames: Iterable[str], chunk_size: int = 100, max_workers: int = 4) -> dict[str, UserInfo]:
+        """
+        get user info of many users, e.g. a course roster. The result has every username, None if it is not in AD.\n
+        The names are searched chunk_size at a time with one OR filter each, max_workers searches at once, each on
+        its own connection of the pool. Like get_user_info, USER_FILTER is not applied.
+        AD compares the names ignoring case, the result is keyed by the names as given.
+        """
+        wanted: dict[str, str] = {}
+        for username in usernames:
+            wanted.setdefault(username.lower(), username)
+        names = list(wanted.values())
+        chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+
+        def search(chunk: list[str]) -> list[UserInfo]:
+            ad = MyAD(self.ad_config, base_uid=self.base_uid, pool=self.pool)
+            ad.force_gid = self.force_gid
+            ad.force_gname = self.force_gname
+            try:
+                return list(ad.iter_user_info(self.users_filter(chunk)))
+            finally:
+                ad.disconnect()
+
+        if len(chunks) <= 1 or max_workers <= 1:
+            found = [search(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks)), thread_name_prefix='ad-many') as executor:
+                found = list(executor.map(search, chunks))
+        result: dict[str, UserInfo] = dict.fromkeys(names)
+        for userinfos in found:
+            for userinfo in userinfos:
+                username = wanted.get(userinfo.username.lower())
+                if username is not None:
+                    result[username] = self._user_info(username, userinfo.sid, userinfo.cn, userinfo.dn, userinfo.mail)
+        return result
+
+    def iter_user_info_all(self, page_size: int = None) -> Iterator[UserInfo]:
+        """
+        yield the user info of all users, see iter_user_info
+        """
+        return self.iter_user_info(page_size=page_size)
 
     def get_user_info_all(self) -> list[UserInfo]:
         """
         get all user info.\n
         """
-        self.connect()
-        username_attr = self.ad_config.USERNAME_ATTRIBUTE
-        self.ad.search(self.ad_config.USER_BASE_DN, self.ad_config.USER_FILTER, SUBTREE, attributes=['objectSid', 'cn', 'mail', username_attr])
-        user_list: list[UserInfo] = [UserInfo(username=entry[username_attr].value, cn=entry.cn.value, uid=self.sid_to_uid(entry.objectSid.value, self.base_uid),
-                                              sid=entry.objectSid.value, dn=entry.entry_dn, mail=entry.mail.value if entry.mail is not None else None) for entry in self.ad.entries]
-        if self.force_gid is not None:
-            for user in user_list:
-                user.gid = self.force_gid
-                user.groupname = self.force_gname
-        return user_list
+        return list(self.iter_user_info_all())
+
+    @classmethod
+    def _value(cls, value):
+        """
+        single value of an attribute in a search response, None if it is missing
+        """
+        if isinstance(value, list):
+            return value[0] if len(value) > 0 else None
+        return value
 
     @classmethod
     def sid_to_uid(cls, sid: str, base_uid: int = 1615200000):
@@ -200,89 +662,762 @@ class MyAD:
         return base_uid + rid
 
 
+@dataclass
+class AsyncLdapConfig:
+    # look the users up in AD on the event loop of the hub, instead of a thread per lookup
+    enable: bool = False
+    # connections to AD, each of them carries many searches at once
+    connections: int = 2
+    # searches in flight on a connection before another connection is opened
+    max_outstanding: int = 64
+    # seconds to wait for the response of a search
+    timeout: float = 10
+
+
+class _AsyncSlot:
+    def __init__(self, conn: Connection) -> None:
+        self.conn = conn
+        self.outstanding = 0
+        # message ids given up, a late response of them is dropped
+        self.abandoned: deque[int] = deque(maxlen=256)
+
+
+class AsyncLdapPool:
+    """
+    A few connections with ldap3's ASYNC strategy, shared by the coroutines of the hub's event loop.\n
+    A search is sent without waiting, its response is collected by polling its message id, so many searches
+    share one connection. Use AsyncLdapPool.get(ldap_config) to get the pool of a server and bind user.
+    """
+    _pools: dict[tuple, 'AsyncLdapPool'] = {}
+    _pools_lock = threading.Lock()
+    # seconds between two polls of a response, doubled up to poll_max
+    poll_min: float = 0.0005
+    poll_max: float = 0.02
+
+    def __init__(self, ldap_config: LdapConfig, config: AsyncLdapConfig = None, factory=None) -> None:
+        if config is None:
+            config = AsyncLdapConfig()
+        self.ldap_config = ldap_config
+        self.config = config
+        # factory() returns a new bound connection with an asynchronous strategy
+        self.factory = factory
+        self.server: Server = None
+        self._slots: list[_AsyncSlot] = []
+        self._open_lock = asyncio.Lock()
+
+    @classmethod
+    def get(cls, ldap_config: LdapConfig, config: AsyncLdapConfig = None) -> 'AsyncLdapPool':
+        """
+        return the pool of the server and bind user of ldap_config, create it if not exists
+        """
+        if config is None:
+            config = AsyncLdapConfig()
+        key = (ldap_config.SERVER_URL, ldap_config.BIND_DN, ldap_config.BIND_PW)
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None or pool.config != config:
+                if pool is not None:
+                    pool.close()
+                pool = cls(ldap_config, config)
+                cls._pools[key] = pool
+            return pool
+
+    def _open(self) -> Connection:
+        """
+        a new bound connection. The bind waits for its response, so this runs in a thread.
+        """
+        if self.factory is not None:
+            return self.factory()
+        if self.server is None:
+            # the schema is read, or loaded from SCHEMA_CACHE_DIR, by a synchronous connection once
+            server, conn = self.ldap_config.open_server()
+            conn.unbind()
+            self.server = server
+        return self.ldap_config.connect(self.server, client_strategy=ASYNC)
+
+    async def _slot(self) -> _AsyncSlot:
+        """
+        the connection with the fewest searches in flight. Another one is opened if all are busy.
+        """
+        async with self._open_lock:
+            self._slots = [slot for slot in self._slots if not slot.conn.closed]
+            slot = min(self._slots, key=lambda slot: slot.outstanding, default=None)
+            if slot is not None and (slot.outstanding < self.config.max_outstanding
+                                     or len(self._slots) >= self.config.connections):
+                return slot
+            conn = await asyncio.get_running_loop().run_in_executor(None, self._open)
+            slot = _AsyncSlot(conn)
+            self._slots.append(slot)
+            return slot
+
+    def _drop(self, slot: _AsyncSlot):
+        if slot in self._slots:
+            self._slots.remove(slot)
+        try:
+            slot.conn.unbind()
+        except LDAPException:
+            pass
+
+    async def search(self, search_base: str, search_filter: str, attributes: list[str], scope=SUBTREE,
+                     timeout: float = None, **kwargs) -> list[dict]:
+        """
+        the entries (searchResEntry responses) found by the search, within timeout seconds (config.timeout)
+        """
+        if timeout is None:
+            timeout = self.config.timeout
+        slot = await self._slot()
+        slot.outstanding += 1
+        try:
+            message_id = slot.conn.search(search_base, search_filter, scope, attributes=attributes, **kwargs)
+            response, result = await self._response(slot, message_id, timeout)
+        except (LDAPCommunicationError, LDAPSessionTerminatedByServerError):
+            self._drop(slot)
+            raise
+        finally:
+            slot.outstanding -= 1
+        if result['result'] not in (RESULT_SUCCESS, RESULT_NO_SUCH_OBJECT):
+            raise LDAPException(f"search of {search_filter} failed: {result['description']} {result['message']}")
+        return [entry for entry in response if entry['type'] == 'searchResEntry']
+
+    async def _response(self, slot: _AsyncSlot, message_id: int, timeout: float) -> tuple[list[dict], dict]:
+        deadline = time.monotonic() + timeout
+        delay = self.poll_min
+        try:
+            while True:
+                try:
+                    return slot.conn.get_response(message_id, timeout=0)
+                except LDAPResponseTimeoutError:
+                    if time.monotonic() >= deadline:
+                        self._abandon(slot, message_id)
+                        raise TimeoutError(f"no response of {self.ldap_config.SERVER_URL} after {timeout}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.poll_max)
+        except asyncio.CancelledError:
+            # e.g. the timeout of the pre-spawn hook
+            self._abandon(slot, message_id)
+            raise
+
+    def _abandon(self, slot: _AsyncSlot, message_id: int):
+        """
+        abandon message_id and drop what ldap3 keeps of it, the connection lives as long as the hub
+        """
+        conn = slot.conn
+        try:
+            conn.abandon(message_id)
+        except LDAPException:
+            pass
+        slot.abandoned.append(message_id)
+        strategy = conn.strategy
+        # the response may still arrive, and ldap3 keeps an event for every message id polled
+        with getattr(strategy, 'async_lock', None) or threading.Lock():
+            for message_id in slot.abandoned:
+                for pending in (strategy._outstanding, getattr(strategy, '_responses', None), getattr(strategy, '_events', None)):
+                    if pending is not None:
+                        pending.pop(message_id, None)
+
+    def close(self):
+        slots, self._slots = self._slots, []
+        for slot in slots:
+            try:
+                slot.conn.unbind()
+            except LDAPException:
+                pass
+
+
+class AsyncMyAD:
+    """
+    The lookups of MyAD as coroutines on an AsyncLdapPool, e.g. await ad.get_user_info(username).
+    Many of them can wait for AD at once on the event loop.
+    """
+
+    def __init__(self, ad: LdapConfig, base_uid: int = 1615200000, pool: AsyncLdapPool = None) -> None:
+        # turns the entries into UserInfo, it never connects
+        self.my_ad = MyAD(ad, base_uid=base_uid)
+        if pool is None:
+            pool = AsyncLdapPool.get(ad)
+        self.pool = pool
+
+    @property
+    def ad_config(self) -> LdapConfig:
+        return self.my_ad.ad_config
+
+    @property
+    def force_gid(self) -> int:
+        return self.my_ad.force_gid
+
+    @force_gid.setter
+    def force_gid(self, gid: int):
+        self.my_ad.force_gid = gid
+
+    @property
+    def force_gname(self) -> str:
+        return self.my_ad.force_gname
+
+    @force_gname.setter
+    def force_gname(self, name: str):
+        self.my_ad.force_gname = name
+
+    async def search(self, search_base: str, search_filter: str, attributes: list[str], scope=SUBTREE,
+                     timeout: float = None, **kwargs) -> list[dict]:
+        """
+        the entries found. If the connection went stale, search again once on another connection.
+        """
+        start = time.perf_counter()
+        result = 'error'
+        try:
+            try:
+                entries = await self.pool.search(search_base, search_filter, attributes, scope=scope, timeout=timeout, **kwargs)
+            except (LDAPCommunicationError, LDAPSessionTerminatedByServerError):
+                entries = await self.pool.search(search_base, search_filter, attributes, scope=scope, timeout=timeout, **kwargs)
+            result = 'ok'
+            return entries
+        finally:
+            LDAP_SEARCH_SECONDS.labels(result).observe(time.perf_counter() - start)
+
+    @classmethod
+    def _sid(cls, attributes: dict) -> str:
+        sid = MyAD._value(attributes.get('objectSid'))
+        # without the schema of the server the value is not formatted
+        if isinstance(sid, bytes):
+            sid = format_sid(sid)
+        return sid
+
+    async def get_user_sid(self, username: str) -> str:
+        """
+        get user sid by username, see MyAD.get_user_sid
+        """
+        entries = await self.search(self.ad_config.USER_BASE_DN, self.ad_config.USER_BASIC_FILTER(username), ['objectSid'])
+        if len(entries) == 0:
+            return None
+        return self._sid(entries[0]['attributes'])
+
+    async def get_user_sid_uid(self, username: str) -> tuple[str, int]:
+        sid = await self.get_user_sid(username)
+        if sid is None:
+            return None, None
+        return sid, MyAD.sid_to_uid(sid, self.my_ad.base_uid)
+
+    async def get_user_info(self, username: str) -> UserInfo:
+        """
+        get user info by username, see MyAD.get_user_info
+        """
+        entries = await self.search(self.ad_config.USER_BASE_DN, self.ad_config.USER_BASIC_FILTER(username),
+                                    ['objectSid', 'cn', 'mail'])
+        if len(entries) == 0:
+            return None
+        entry = entries[0]
+        attributes = entry['attributes']
+        return self.my_ad._user_info(username, self._sid(attributes), MyAD._value(attributes.get('cn')), entry['dn'],
+                                     MyAD._value(attributes.get('mail')))
+
+
+@dataclass
+class SyncStats:
+    rows: int = 0
+    seconds: float = 0
+    # full, delta or preload
+    mode: str = 'full'
+    deleted: int = 0
+
+    @property
+    def rows_per_sec(self) -> float:
+        if self.seconds <= 0:
+            return 0
+        return self.rows / self.seconds
+
+    def __str__(self) -> str:
+        return f"{self.mode} sync: {self.rows} rows, {self.deleted} deleted in {self.seconds:.2f}s ({self.rows_per_sec:.0f} rows/s)"
+
+
+@dataclass
+class SyncState:
+    """
+    high-water mark of the sync from one domain controller
+    """
+    server: str
+    usn: int
+    # time.time() of the last full sync and of the last sync
+    full_sync_at: float = None
+    sync_at: float = None
+
+
+@dataclass
+class SyncConfig:
+    # run the background sync of the local cache, see AdSync.AdSyncService
+    enable: bool = False
+    # seconds between two syncs, plus a random delay of up to jitter seconds
+    interval: float = 60
+    jitter: float = 10
+    # delta or full
+    mode: str = 'delta'
+    # json file with the status of the last sync, None to not write it
+    status_file: str = None
+    # seconds between full syncs, which also remove the users that left USER_FILTER
+    reconcile_interval: float = 86400
+    # remove deleted users between full syncs by reading the tombstones
+    tombstones: bool = False
+
+
+@dataclass
+class PreloadConfig:
+    # load the users allowed by the config into the local cache when the hub starts
+    enable: bool = False
+    # rows between two progress reports
+    progress_every: int = 1000
+    # users per search and searches at once when only the allowed users are loaded, see MyAD.get_user_info_many
+    chunk_size: int = 100
+    max_workers: int = 4
+
+
+@dataclass
+class CacheConfig:
+    enable: bool = True
+    # max number of users kept in memory
+    max_size: int = 4096
+    # seconds a user found in AD is kept
+    ttl: float = 300
+    # seconds a user not found in AD is remembered as missing
+    negative_ttl: float = 60
+
+
+class UserCache:
+    """
+    In-memory LRU cache of UserInfo in front of UserSql.\n
+    A user not found in AD is stored as None for negative_ttl seconds, so that it is not searched in AD on every spawn.
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 300, negative_ttl: float = 60) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data: OrderedDict[str, tuple[UserInfo, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits: int = 0
+        self.negative_hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    @classmethod
+    def from_config(cls, config: CacheConfig) -> 'UserCache':
+        return cls(max_size=config.max_size, ttl=config.ttl, negative_ttl=config.negative_ttl)
+
+    def get(self, username: str) -> tuple[bool, UserInfo]:
+        """
+        return (found, userinfo). userinfo is a copy, and None if the user is known to be missing.
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(username)
+            if item is None or item[1] < now:
+                if item is not None:
+                    del self._data[username]
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(username)
+            userinfo = item[0]
+            if userinfo is None:
+                self.negative_hits += 1
+                return True, None
+            self.hits += 1
+        return True, replace(userinfo)
+
+    def put(self, username: str, userinfo: UserInfo):
+        """
+        store userinfo, None to store the user as missing
+        """
+        ttl = self.negative_ttl if userinfo is None else self.ttl
+        if ttl <= 0:
+            return
+        if userinfo is not None:
+            userinfo = replace(userinfo)
+        with self._lock:
+            self._data[username] = (userinfo, time.monotonic() + ttl)
+            self._data.move_to_end(username)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, username: str):
+        with self._lock:
+            self._data.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'negative_hits': self.negative_hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
 class UserSql:
+    """
+    The local cache of AD users in sqlite.\n
+    Each thread keeps its own connection open, in WAL mode so readers do not wait for a running sync.
+    """
+
     def __init__(self, db: str):
         self.db_connect_info = db
-        self.__sql: sqlite3.Connection = None
-        self.__c: sqlite3.Cursor = None
-        self.table: str = 'AD_USER'
+        self.__local = threading.local()
+        self.__table: str = 'AD_USER'
+        self.__schema_ready = False
+        self.__schema_lock = threading.Lock()
+        # rows per executemany in bulk inserts
+        self.batch_size: int = 1000
+        # seconds to wait for a lock held by another connection
+        self.busy_timeout: float = 5
+        # seconds after which a user is refreshed from AD in the background, None to never refresh
+        self.max_age: float = None
+        # seconds after which a user is refreshed from AD before it is returned, None to never wait for AD
+        self.hard_max_age: float = None
+
+    @property
+    def table(self) -> str:
+        return self.__table
+
+    @table.setter
+    def table(self, table: str):
+        self.__table = table
+        self.__schema_ready = False
+
+    @property
+    def columns(self) -> str:
+        return ', '.join(field.name for field in fields(UserInfo))
 
     @property
     def cursor(self) -> sqlite3.Cursor:
-        return self.__c
+        return getattr(self.__local, 'cursor', None)
 
     @property
     def sql(self) -> sqlite3.Connection:
-        return self.__sql
+        return getattr(self.__local, 'sql', None)
 
     def connect(self):
         """
-        connect to sqlite database. If already connected, do nothing.
+        connect to sqlite database. If already connected, do nothing.\n
+        The connection belongs to the calling thread and stays open for the next calls.
         """
-        if self.__sql is not None:
-            self.disconnect()
-        self.__sql = sqlite3.connect(self.db_connect_info)
-        self.__c = self.__sql.cursor()
-        self.create_table()
+        if self.sql is None:
+            sql = sqlite3.connect(self.db_connect_info, timeout=self.busy_timeout)
+            sql.execute("PRAGMA journal_mode=WAL;")
+            sql.execute("PRAGMA synchronous=NORMAL;")
+            self.__local.sql = sql
+            self.__local.cursor = sql.cursor()
+        if not self.__schema_ready:
+            self.ensure_schema()
 
     def disconnect(self):
         """
-        disconnect from sqlite database. If already disconnected, do nothing.
+        disconnect from sqlite database. If already disconnected, do nothing.\n
+        Only the connection of the calling thread is closed.
+        """
+        if self.sql is not None:
+            self.sql.close()
+            self.__local.sql = None
+            self.__local.cursor = None
+
+    def ensure_schema(self):
+        """
+        create the tables and the unique index on username, once per table
+        """
+        with self.__schema_lock:
+            if self.__schema_ready:
+                return
+            self.create_table()
+            self.migrate_table()
+            self.create_state_table()
+            self.create_index()
+            self.__schema_ready = True
+
+    def create_index(self, table: str = None, commit: bool = True, dedupe: bool = True):
+        """
+        create the unique index on username. Duplicated usernames, which older versions could insert, are removed first,
+        unless dedupe is False.
         """
-        if self.__sql is not None:
-            self.__sql.close()
-            self.__sql = None
-            self.__c = None
+        if table is None:
+            table = self.table
+        if dedupe:
+            self.dedupe(table)
+        self.cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_username ON {table} (username);")
+        if commit:
+            self.sql.commit()
 
-    def create_table(self):
+    def dedupe(self, table: str = None, commit: bool = False):
+        """
+        remove the rows of a username but the last one
+        """
+        if table is None:
+            table = self.table
+        self.cursor.execute(f"DELETE FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY username);")
+        if commit:
+            self.sql.commit()
+
+    def create_table(self, table: str = None, commit: bool = True):
         """
         create table if not exists
         """
+        if table is None:
+            table = self.table
         # self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
         # print(self.cursor.fetchall())
-        check_table_query = f"SELECT count(name) FROM sqlite_master WHERE type='table' AND name='{self.table}';"
+        check_table_query = "SELECT count(name) FROM sqlite_master WHERE type='table' AND name=?;"
         # print(check_table_query)
-        self.cursor.execute(check_table_query)
+        self.cursor.execute(check_table_query, (table,))
         result = self.cursor.fetchone()
         # print(result)
         if result[0] == 0:
-            create_table_query = f"CREATE TABLE IF NOT EXISTS {self.table} (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            create_table_query = f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, "
             for field in fields(UserInfo):
-                if field.type is int:
-                    create_table_query += f"{field.name} INTEGER"
-                else:
-                    create_table_query += f"{field.name} TEXT"
+                create_table_query += f"{field.name} {self.column_type(field.type)}"
                 if field is not fields(UserInfo)[-1]:
                     create_table_query += ", "
             create_table_query += ");"
             # print(create_table_query)
             self.cursor.execute(create_table_query)
-            self.sql.commit()
+            if commit:
+                self.sql.commit()
 
-    def insert(self, userinfo: UserInfo):
+    @classmethod
+    def column_type(cls, type_) -> str:
+        if type_ is int:
+            return "INTEGER"
+        if type_ is float:
+            return "REAL"
+        return "TEXT"
+
+    def migrate_table(self, table: str = None):
         """
-        insert userinfo to table
+        add the columns of UserInfo missing in a table created by an older version.
+        Their rows have no refreshed_at and are refreshed from AD on next use.
         """
-        insert_query = f"INSERT INTO {self.table} ("
-        for field in fields(UserInfo):
-            insert_query += f"{field.name}"
-            if field is not fields(UserInfo)[-1]:
-                insert_query += ", "
-        insert_query += ") VALUES ("
+        if table is None:
+            table = self.table
+        self.cursor.execute(f"PRAGMA table_info({table})")
+        existing = {row[1] for row in self.cursor.fetchall()}
         for field in fields(UserInfo):
-            insert_query += f"'{getattr(userinfo, field.name)}'"
-            if field is not fields(UserInfo)[-1]:
-                insert_query += ", "
-        insert_query += ");"
-        self.cursor.execute(insert_query)
+            if field.name not in existing:
+                self.cursor.execute(f"ALTER TABLE {table} ADD COLUMN {field.name} {self.column_type(field.type)}")
         self.sql.commit()
 
-    def insert_all(self, userinfos: list[UserInfo]):
+    def insert_query(self, table: str = None) -> str:
+        """
+        parameterized INSERT of all UserInfo fields
+        """
+        if table is None:
+            table = self.table
+        names = [field.name for field in fields(UserInfo)]
+        return f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)});"
+
+    def upsert_query(self) -> str:
+        """
+        parameterized INSERT of all UserInfo fields, which updates the row of an existing username
+        """
+        updates = ', '.join(f"{field.name}=excluded.{field.name}" for field in fields(UserInfo) if field.name != 'username')
+        return self.insert_query()[:-1] + f" ON CONFLICT(username) DO UPDATE SET {updates};"
+
+    @classmethod
+    def to_row(cls, userinfo: UserInfo) -> tuple:
+        """
+        the values of userinfo. refreshed_at is set to now if missing, rows are written right after the read from AD.
+        """
+        if userinfo.refreshed_at is None:
+            userinfo.refreshed_at = time.time()
+        return tuple(getattr(userinfo, field.name) for field in fields(UserInfo))
+
+    def is_stale(self, userinfo: UserInfo, max_age: float = None, now: float = None) -> bool:
         """
-        insert userinfos to table
+        whether userinfo was read from AD more than max_age (default self.max_age) seconds ago
         """
-        for userinfo in userinfos:
-            self.insert(userinfo)
+        if max_age is None:
+            max_age = self.max_age
+        if max_age is None:
+            return False
+        if userinfo.refreshed_at is None:
+            return True
+        if now is None:
+            now = time.time()
+        return now - userinfo.refreshed_at > max_age
+
+    def insert(self, userinfo: UserInfo):
+        """
+        insert userinfo to table, or update the row with the same username
+        """
+        with timed(USER_SQL_SECONDS, 'upsert'):
+            try:
+                self.cursor.execute(self.upsert_query(), self.to_row(userinfo))
+                self.sql.commit()
+            except BaseException:
+                # the connection of this thread is kept, it must not stay in the failed transaction
+                self.sql.rollback()
+                raise
+
+    def _insert_batches(self, userinfos: Iterable[UserInfo], table: str = None, commit: bool = False) -> int:
+        """
+        insert userinfos with executemany, batch_size rows at a time. Return the number of rows.
+        With commit, every batch is committed, the write lock is not held while userinfos is read.
+        """
+        query = self.insert_query(table)
+        rows = 0
+        userinfos = iter(userinfos)
+        while True:
+            batch = [self.to_row(userinfo) for userinfo in itertools.islice(userinfos, self.batch_size)]
+            if len(batch) == 0:
+                return rows
+            self.cursor.executemany(query, batch)
+            rows += len(batch)
+            if commit:
+                self.sql.commit()
+
+    def insert_all(self, userinfos: Iterable[UserInfo]):
+        """
+        insert userinfos to table in one transaction
+        """
+        try:
+            self._insert_batches(userinfos)
+            self.sql.commit()
+        except BaseException:
+            self.sql.rollback()
+            raise
+
+    def sync_all(self, userinfos: Iterable[UserInfo]) -> SyncStats:
+        """
+        replace the content of table by userinfos.\n
+        The rows are written to a staging table, which then takes the place of table in one transaction.
+        Readers see either the old or the new content, never an empty or partial table.
+        """
+        return self.sync_full(userinfos, None)
+
+    @property
+    def state_table(self) -> str:
+        return f"{self.table}_sync"
+
+    def create_state_table(self):
+        """
+        create the table of the sync high-water marks if not exists
+        """
+        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {self.state_table} "
+                            "(server TEXT PRIMARY KEY, usn INTEGER, full_sync_at REAL, sync_at REAL);")
+        self.sql.commit()
+
+    def get_sync_state(self, server: str) -> SyncState:
+        """
+        get the high-water mark of server, None if it was never synced
+        """
+        self.cursor.execute(f"SELECT server, usn, full_sync_at, sync_at FROM {self.state_table} WHERE server=?", (server,))
+        result = self.cursor.fetchone()
+        if result is None:
+            return None
+        return SyncState(*result)
+
+    def _set_sync_state(self, state: SyncState):
+        self.cursor.execute(f"INSERT OR REPLACE INTO {self.state_table} (server, usn, full_sync_at, sync_at) VALUES (?, ?, ?, ?);",
+                            (state.server, state.usn, state.full_sync_at, state.sync_at))
+
+    def sync_full(self, userinfos: Iterable[UserInfo], state: SyncState) -> SyncStats:
+        """
+        sync_all, and store the high-water mark state (if not None) in the transaction of the swap.\n
+        userinfos is usually read from AD while it is written, which may take minutes. The staging table is filled
+        in short transactions meanwhile, so user_check can still write table. Only the swap holds the write lock.
+        """
+        start = time.monotonic()
+        staging = f"{self.table}_staging"
+        try:
+            self.cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+            self.create_table(staging, commit=False)
+            self.sql.commit()
+            rows = self._insert_batches(userinfos, staging, commit=True)
+            self.dedupe(staging)
+            self.sql.commit()
+            self.cursor.execute("BEGIN IMMEDIATE")
+            self.cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+            self.cursor.execute(f"ALTER TABLE {staging} RENAME TO {self.table}")
+            self.create_index(commit=False, dedupe=False)
+            if state is not None:
+                self._set_sync_state(state)
+            self.sql.commit()
+        except BaseException:
+            self.sql.rollback()
+            raise
+        return SyncStats(rows=rows, seconds=time.monotonic() - start)
+
+    def _upsert_batches(self, userinfos: Iterable[UserInfo]) -> int:
+        query = self.upsert_query()
+        rows = 0
+        userinfos = iter(userinfos)
+        while True:
+            batch = [self.to_row(userinfo) for userinfo in itertools.islice(userinfos, self.batch_size)]
+            if len(batch) == 0:
+                return rows
+            self.cursor.executemany(query, batch)
+            rows += len(batch)
+
+    def _delete_sids(self, sids: Iterable[str]) -> int:
+        deleted = 0
+        sids = iter(sids)
+        while True:
+            batch = [(sid,) for sid in itertools.islice(sids, self.batch_size)]
+            if len(batch) == 0:
+                return deleted
+            self.cursor.executemany(f"DELETE FROM {self.table} WHERE sid=?", batch)
+            deleted += len(batch)
+
+    def _delete_usernames(self, usernames: Iterable[str]) -> int:
+        deleted = 0
+        usernames = iter(usernames)
+        while True:
+            batch = [(username,) for username in itertools.islice(usernames, self.batch_size)]
+            if len(batch) == 0:
+                return deleted
+            self.cursor.executemany(f"DELETE FROM {self.table} WHERE username=?", batch)
+            deleted += len(batch)
+
+    def upsert_many(self, results: dict[str, UserInfo]) -> tuple[int, int]:
+        """
+        write a result of MyAD.get_user_info_many in one transaction: the users found are upserted, the rows of the
+        users not found are deleted. Return the number of both.
+        """
+        with timed(USER_SQL_SECONDS, 'upsert_many'):
+            try:
+                rows = self._upsert_batches(user for user in results.values() if user is not None)
+                deleted = self._delete_usernames(username for username, user in results.items() if user is None)
+                self.sql.commit()
+            except BaseException:
+                self.sql.rollback()
+                raise
+        return rows, deleted
+
+    def upsert_all(self, userinfos: Iterable[UserInfo]) -> int:
+        """
+        insert userinfos, replacing the rows with the same username, in one transaction
+        """
+        try:
+            rows = self._upsert_batches(userinfos)
+            self.sql.commit()
+        except BaseException:
+            self.sql.rollback()
+            raise
+        return rows
+
+    def sync_delta(self, changed: Iterable[UserInfo], deleted_sids: Iterable[str], state: SyncState) -> SyncStats:
+        """
+        upsert the changed users, delete the users of deleted_sids and store the high-water mark state, in one transaction.\n
+        changed and deleted_sids are usually read from AD while they are iterated, they are read before the write lock
+        is taken, see sync_full. A delta is small.
+        """
+        start = time.monotonic()
+        changed = list(changed)
+        deleted_sids = list(deleted_sids)
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            rows = self._upsert_batches(changed)
+            deleted = self._delete_sids(deleted_sids)
+            self._set_sync_state(state)
+            self.sql.commit()
+        except BaseException:
+            self.sql.rollback()
+            raise
+        return SyncStats(rows=rows, seconds=time.monotonic() - start, mode='delta', deleted=deleted)
 
     def print(self):
         """
@@ -295,18 +1430,31 @@ class UserSql:
         """
         get all data in table
         """
-        self.cursor.execute(f"SELECT * FROM {self.table}")
-        return [UserInfo(*row[1:]) for row in self.cursor.fetchall()]
+        self.cursor.execute(f"SELECT {self.columns} FROM {self.table}")
+        return [UserInfo(*row) for row in self.cursor.fetchall()]
 
     def get_by_username(self, username: str) -> UserInfo:
         """
         get data by username
         """
-        self.cursor.execute(f"SELECT * FROM {self.table} WHERE username='{username}'")
-        result = self.cursor.fetchone()
+        with timed(USER_SQL_SECONDS, 'get'):
+            self.cursor.execute(f"SELECT {self.columns} FROM {self.table} WHERE username=?", (username,))
+            result = self.cursor.fetchone()
         if result is None:
             return None
-        return UserInfo(*result[1:])
+        return UserInfo(*result)
+
+    def delete_by_username(self, username: str):
+        """
+        delete the row of username
+        """
+        with timed(USER_SQL_SECONDS, 'delete'):
+            try:
+                self.cursor.execute(f"DELETE FROM {self.table} WHERE username=?", (username,))
+                self.sql.commit()
+            except BaseException:
+                self.sql.rollback()
+                raise
 
     def delete_table(self):
         """
@@ -314,6 +1462,7 @@ class UserSql:
         """
         self.cursor.execute(f"DROP TABLE {self.table}")
         self.sql.commit()
+        self.__schema_ready = False
 
 
 class AdUser:
@@ -329,32 +1478,375 @@ class AdUser:
         self.append_groups: list[str] = None
         self.allow_users: list[str] = None
         self.start_uid: int = start_uid
+        self.pool_config: PoolConfig = None
+        self.sync_config: SyncConfig = SyncConfig()
+        self.cache_config: CacheConfig = CacheConfig()
+        self.preload_config: PreloadConfig = PreloadConfig()
+        self.async_config: AsyncLdapConfig = AsyncLdapConfig()
+        self.__pool: LdapPool = None
+        self.__cache: UserCache = None
+        # concurrent lookups and refreshes of the same username share one search in AD
+        self.__flight = SingleFlight()
+        self.__async_flight = AsyncSingleFlight()
+        # background refresh of stale users
+        self.__refresh_executor: ThreadPoolExecutor = None
+        self.__refresh_lock = threading.Lock()
+        # local cache reads and writes of user_check_async, off the event loop
+        self.__sql_executor: ThreadPoolExecutor = None
+        # after close, the executors are not created again, see ConfigSnapshot.executor
+        self.__closed = False
+
+    @property
+    def pool(self) -> LdapPool:
+        """
+        the shared connection pool of ldap_config
+        """
+        if self.__pool is None:
+            self.__pool = LdapPool.get(self.ldap_config, self.pool_config)
+        return self.__pool
 
-    def user_sync(self):
-        ad = MyAD(self.ldap_config, base_uid=self.start_uid)
-        ad.connect()
-        users = ad.get_user_info_all()
-        ad.disconnect()
+    @property
+    def cache(self) -> UserCache:
+        """
+        the in-memory cache in front of sql, None if disabled
+        """
+        if self.__cache is None and self.cache_config.enable:
+            self.__cache = UserCache.from_config(self.cache_config)
+        return self.__cache
+
+    def my_ad(self) -> MyAD:
+        ad = MyAD(self.ldap_config, base_uid=self.start_uid, pool=self.pool)
+        ad.force_gid = self.force_gid
+        ad.force_gname = self.force_gname
+        return ad
+
+    def my_ad_async(self) -> AsyncMyAD:
+        ad = AsyncMyAD(self.ldap_config, base_uid=self.start_uid, pool=AsyncLdapPool.get(self.ldap_config, self.async_config))
+        ad.force_gid = self.force_gid
+        ad.force_gname = self.force_gname
+        return ad
+
+    def user_sync(self) -> SyncStats:
+        """
+        replace the local cache by all users of AD.\n
+        The high-water mark for user_sync_delta is stored too, if the server has one (only AD has).
+        """
+        ad = self.my_ad()
+        self.sql.connect()
+        try:
+            # the high-water mark is read first, changes made during the sync are fetched again next time
+            stats = self.sql.sync_full(ad.iter_user_info_all(), self._full_sync_state(ad))
+        finally:
+            ad.disconnect()
+        self._synced(stats)
+        return stats
+
+    def _full_sync_state(self, ad: MyAD) -> SyncState | None:
+        """
+        the sync state of a full sync starting now, None if the server has no high-water mark
+        """
+        now = time.time()
+        try:
+            server, usn = ad.get_usn()
+        except LDAPCommunicationError:
+            raise
+        except LDAPException as e:
+            # e.g. OpenLDAP, the full sync works without it
+            log.debug("no high-water mark, the sync state is not stored: %s", e)
+            return None
+        return SyncState(server, usn, full_sync_at=now, sync_at=now)
+
+    def user_sync_delta(self) -> SyncStats:
+        """
+        update the local cache with the users changed in AD since the last sync.\n
+        It falls back to user_sync if this domain controller was never synced, or the last full sync is older
+        than sync_config.reconcile_interval.
+        """
+        ad = self.my_ad()
         self.sql.connect()
-        self.sql.delete_table()
-        self.sql.create_table()
-        self.sql.insert_users_all(users)
-        self.sql.disconnect()
+        try:
+            server, usn = ad.get_usn()
+            state = self.sql.get_sync_state(server)
+            now = time.time()
+            if state is None or state.full_sync_at is None or usn < state.usn \
+                    or now - state.full_sync_at > self.sync_config.reconcile_interval:
+                stats = self.sql.sync_full(ad.iter_user_info_all(), SyncState(server, usn, full_sync_at=now, sync_at=now))
+            else:
+                changed = ad.iter_user_info_changed(state.usn) if usn > state.usn else iter(())
+                if self.sync_config.tombstones and usn > state.usn:
+                    deleted = list(ad.iter_deleted_sids(state.usn))
+                else:
+                    deleted = []
+                stats = self.sql.sync_delta(changed, deleted, SyncState(server, usn, full_sync_at=state.full_sync_at, sync_at=now))
+        finally:
+            ad.disconnect()
+        self._synced(stats)
+        return stats
+
+    def preload(self, progress: Callable[[int, float], None] = None) -> SyncStats:
+        """
+        load the users allowed by the config (all users if allow_users is not set) into the local cache,
+        with one paged search, or a few batched searches for allow_users, and the first of them into the memory cache.\n
+        Loading all users is a full sync, see user_sync. Its sync state is stored, so the first user_sync_delta
+        does not read the directory again.
+        progress is called with the rows and seconds so far every preload_config.progress_every rows.
+        """
+        start = time.monotonic()
+        ad = self.my_ad()
+        self.sql.connect()
+        cache = self.cache
+        state = None
+        if self.allow_users is not None:
+            users = ad.get_user_info_many(self.allow_users, chunk_size=self.preload_config.chunk_size,
+                                          max_workers=self.preload_config.max_workers)
+            userinfos = (user for user in users.values() if user is not None)
+        else:
+            state = self._full_sync_state(ad)
+            userinfos = ad.iter_user_info_all()
+
+        def report(userinfos: Iterable[UserInfo]) -> Iterator[UserInfo]:
+            for rows, userinfo in enumerate(userinfos, 1):
+                userinfo.refreshed_at = time.time()
+                if cache is not None and rows <= cache.max_size:
+                    cache.put(userinfo.username, userinfo)
+                yield userinfo
+                if progress is not None and rows % self.preload_config.progress_every == 0:
+                    progress(rows, time.monotonic() - start)
+
+        try:
+            if self.allow_users is not None:
+                rows = self.sql.upsert_all(report(userinfos))
+            else:
+                rows = self.sql.sync_full(report(userinfos), state).rows
+        finally:
+            ad.disconnect()
+        stats = SyncStats(rows=rows, seconds=time.monotonic() - start, mode='preload')
+        AD_SYNC_SECONDS.labels(stats.mode).observe(stats.seconds)
+        return stats
+
+    def _synced(self, stats: SyncStats):
+        AD_SYNC_SECONDS.labels(stats.mode).observe(stats.seconds)
+        # users found or removed by the sync must not be answered from memory
+        if self.__cache is not None and (stats.rows > 0 or stats.deleted > 0):
+            self.__cache.clear()
 
     def user_check(self, username: str) -> UserInfo:
         """
-        search user in db,if not exist,search in ad and insert into db
+        search user in memory and db,if not exist,search in ad and insert into db.\n
+        Users not found in ad are remembered in memory for cache_config.negative_ttl seconds.
+        A user older than sql.max_age is returned and refreshed in the background,
+        a user older than sql.hard_max_age is refreshed before it is returned.
+        Concurrent calls for the same username wait for one lookup.
+        """
+        start = time.perf_counter()
+        cache = self.cache
+        found = False
+        source = 'memory'
+        try:
+            if cache is not None:
+                found, user = cache.get(username)
+            if not found:
+                user, source = self.__flight.do(('lookup', username), self._user_lookup_cached, username)
+        except Exception:
+            USER_CHECK_SECONDS.labels(source if found else 'ad', 'error').observe(time.perf_counter() - start)
+            raise
+        USER_CHECK_SECONDS.labels(source, 'missing' if user is None else 'found').observe(time.perf_counter() - start)
+        if user is not None and self.force_gid is not None:
+            user.gid = self.force_gid
+            user.groupname = self.force_gname
+        return user
+
+    def _user_lookup_cached(self, username: str) -> tuple[UserInfo, str]:
+        user, source = self._user_lookup(username)
+        if self.cache is not None:
+            self.cache.put(username, user)
+        return user, source
+
+    def _user_lookup(self, username: str) -> tuple[UserInfo, str]:
+        """
+        the user from sql or AD, and where it was found (sql or ad)
         """
         self.sql.connect()
         user = self.sql.get_by_username(username)
         if user is None:
-            ad = MyAD(self.ldap_config)
-            ad.connect()
+            return self._user_from_ad(username), 'ad'
+        now = time.time()
+        # rows of older versions have no refreshed_at, they are only refreshed in the background
+        if user.refreshed_at is not None and self.sql.is_stale(user, self.sql.hard_max_age, now):
+            try:
+                return self._user_from_ad(username), 'ad'
+            except (LDAPException, TimeoutError) as e:
+                # AD is not reachable, the old entry is better than no user
+                log.warning("refresh of %s from AD failed, using the cached entry: %s", username, e)
+        elif self.sql.is_stale(user, now=now):
+            self.refresh_later(username)
+        return user, 'sql'
+
+    def _user_from_ad(self, username: str) -> UserInfo:
+        """
+        read username from AD and write it to the local cache. A user removed from AD is removed from the cache.
+        """
+        ad = self.my_ad()
+        try:
             user = ad.get_user_info(username)
+        finally:
+            ad.disconnect()
+        self._store(username, user)
+        return user
+
+    def _store(self, username: str, user: UserInfo):
+        self.sql.connect()
+        try:
             if user is not None:
                 self.sql.insert(user)
-        self.sql.disconnect()
+            else:
+                self.sql.delete_by_username(username)
+        except sqlite3.OperationalError:
+            # the cache is locked, e.g. by a running sync. It is filled next time.
+            pass
+
+    def user_check_many(self, usernames: Iterable[str]) -> dict[str, UserInfo]:
+        """
+        user_check of many users, e.g. a course roster, None for the users not in AD.\n
+        Users in memory or fresh in db are not searched, the others are read from AD with
+        MyAD.get_user_info_many, preload_config.chunk_size at a time, and written to db in one transaction.
+        """
+        cache = self.cache
+        result: dict[str, UserInfo] = {}
+        missing: list[str] = []
+        self.sql.connect()
+        now = time.time()
+        for username in usernames:
+            if username in result:
+                continue
+            found = False
+            if cache is not None:
+                found, user = cache.get(username)
+            if not found:
+                user = self.sql.get_by_username(username)
+                found = user is not None and not self.sql.is_stale(user, now=now)
+            if found:
+                result[username] = user
+            else:
+                missing.append(username)
+        if len(missing) > 0:
+            ad = self.my_ad()
+            users = ad.get_user_info_many(missing, chunk_size=self.preload_config.chunk_size,
+                                          max_workers=self.preload_config.max_workers)
+            try:
+                self.sql.upsert_many(users)
+            except sqlite3.OperationalError:
+                # the cache is locked, e.g. by a running sync. It is filled next time.
+                pass
+            # users is keyed by the first of the names that differ only in case
+            users = {username.lower(): user for username, user in users.items()}
+            for username in missing:
+                user = users[username.lower()]
+                result[username] = user
+                if cache is not None:
+                    cache.put(username, user)
         if self.force_gid is not None:
+            for user in result.values():
+                if user is not None:
+                    user.gid = self.force_gid
+                    user.groupname = self.force_gname
+        return result
+
+    async def user_check_async(self, username: str) -> UserInfo:
+        """
+        user_check with the search in AD on the event loop, see AsyncMyAD. The local cache is read and written
+        on a thread of its own, see _sql_executor.
+        """
+        start = time.perf_counter()
+        cache = self.cache
+        found = False
+        source = 'memory'
+        try:
+            if cache is not None:
+                found, user = cache.get(username)
+            if not found:
+                user, source = await self.__async_flight.do(('lookup', username), self._user_lookup_async, username)
+        except Exception:
+            USER_CHECK_SECONDS.labels(source if found else 'ad', 'error').observe(time.perf_counter() - start)
+            raise
+        USER_CHECK_SECONDS.labels(source, 'missing' if user is None else 'found').observe(time.perf_counter() - start)
+        if user is not None and self.force_gid is not None:
             user.gid = self.force_gid
             user.groupname = self.force_gname
         return user
+
+    async def _user_lookup_async(self, username: str) -> tuple[UserInfo, str]:
+        """
+        _user_lookup, and the result put into the memory cache
+        """
+        # connect may create the schema, and a read waits while a sync swaps the table
+        user = await asyncio.get_running_loop().run_in_executor(self._sql_executor(), self._load, username)
+        source = 'sql'
+        now = time.time()
+        if user is None:
+            user, source = await self._user_from_ad_async(username), 'ad'
+        elif user.refreshed_at is not None and self.sql.is_stale(user, self.sql.hard_max_age, now):
+            try:
+                user, source = await self._user_from_ad_async(username), 'ad'
+            except (LDAPException, TimeoutError) as e:
+                log.warning("refresh of %s from AD failed, using the cached entry: %s", username, e)
+        elif self.sql.is_stale(user, now=now):
+            self.refresh_later(username)
+        if self.cache is not None:
+            self.cache.put(username, user)
+        return user, source
+
+    async def _user_from_ad_async(self, username: str) -> UserInfo:
+        user = await self.my_ad_async().get_user_info(username)
+        await asyncio.get_running_loop().run_in_executor(self._sql_executor(), self._store, username, user)
+        return user
+
+    def _load(self, username: str) -> UserInfo:
+        self.sql.connect()
+        return self.sql.get_by_username(username)
+
+    def refresh_later(self, username: str) -> bool:
+        """
+        refresh username from AD in a background thread. Return False if a refresh of username is already running.
+        """
+        return self.__flight.do_later(('refresh', username), self._refresh, username, executor=self._refresh_executor())
+
+    def _refresh_executor(self) -> ThreadPoolExecutor | None:
+        """
+        the pool of the background refreshes, None after close (a daemon thread is used then)
+        """
+        with self.__refresh_lock:
+            if self.__refresh_executor is None and not self.__closed:
+                self.__refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ad-refresh')
+            return self.__refresh_executor
+
+    def _sql_executor(self) -> ThreadPoolExecutor | None:
+        """
+        the pool of the local cache access of user_check_async, None after close (the loop's default executor is used then)
+        """
+        with self.__refresh_lock:
+            if self.__sql_executor is None and not self.__closed:
+                self.__sql_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ad-sql')
+            return self.__sql_executor
+
+    def _refresh(self, username: str):
+        try:
+            self.sql.connect()
+            user = self._user_from_ad(username)
+            if self.__cache is not None:
+                self.__cache.put(username, user)
+        except Exception as e:
+            log.warning("background refresh of %s from AD failed: %s", username, e)
+
+    def close(self):
+        """
+        stop the background refresh. Running refreshes are allowed to finish.
+        """
+        with self.__refresh_lock:
+            self.__closed = True
+            if self.__refresh_executor is not None:
+                self.__refresh_executor.shutdown(wait=False)
+                self.__refresh_executor = None
+            if self.__sql_executor is not None:
+                self.__sql_executor.shutdown(wait=False)
+                self.__sql_executor = None
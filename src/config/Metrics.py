@@ -0,0 +1,124 @@
+from __future__ import annotations
+from contextlib import contextmanager
+import time
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram
+except ImportError:
+    # the scripts can run without the hub and its prometheus_client
+    Counter = Gauge = Histogram = None
+
+
+class NoMetric:
+    """
+    Stands in for a metric when prometheus_client is not installed.
+    """
+
+    def labels(self, *args, **kwargs) -> NoMetric:
+        return self
+
+    def observe(self, value: float):
+        pass
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def set_function(self, f):
+        pass
+
+
+# lookups answered from memory take microseconds, the default buckets start at 5ms
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SLOW_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def histogram(name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets=FAST_BUCKETS):
+    """
+    a histogram in the default registry, which JupyterHub serves on /hub/metrics
+    """
+    if Histogram is None:
+        return NoMetric()
+    return Histogram(name, documentation, labelnames, buckets=buckets)
+
+
+def gauge(name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+    if Gauge is None:
+        return NoMetric()
+    return Gauge(name, documentation, labelnames)
+
+
+def counter(name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+    if Counter is None:
+        return NoMetric()
+    return Counter(name, documentation, labelnames)
+
+
+@contextmanager
+def timed(metric, *labels):
+    """
+    with timed(METRIC, 'label'): ... observes the duration of the block, also if it raises
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if labels:
+            metric = metric.labels(*labels)
+        metric.observe(time.perf_counter() - start)
+
+
+CONFIG_LOAD_SECONDS = histogram(
+    'jupyterhub_config_load_duration_seconds',
+    'Time to read and parse config.yaml')
+
+USER_CHECK_SECONDS = histogram(
+    'jupyterhub_ad_user_check_duration_seconds',
+    'Time of AdUser.user_check, by where the user was found (memory, sql, ad) and result (found, missing, error)',
+    ('source', 'result'))
+
+USER_SQL_SECONDS = histogram(
+    'jupyterhub_ad_cache_query_duration_seconds',
+    'Time of the queries of the local AD cache (sqlite)',
+    ('query',))
+
+AD_SYNC_SECONDS = histogram(
+    'jupyterhub_ad_sync_duration_seconds',
+    'Time of the syncs of the local AD cache, by mode (full, delta, preload)',
+    ('mode',), buckets=SLOW_BUCKETS)
+
+LDAP_SEARCH_SECONDS = histogram(
+    'jupyterhub_ldap_search_duration_seconds',
+    'Time of the LDAP searches of single entries, by result (ok, error)',
+    ('result',))
+
+LDAP_POOL_WAIT_SECONDS = histogram(
+    'jupyterhub_ldap_pool_wait_duration_seconds',
+    'Time to borrow a connection from the LDAP pool, including opening it')
+
+LDAP_POOL_CONNECTIONS = gauge(
+    'jupyterhub_ldap_pool_connections',
+    'Connections of the LDAP pools, by state (in_use, idle)',
+    ('state',))
+
+OIDC_DISCOVERY_SECONDS = histogram(
+    'jupyterhub_oidc_discovery_duration_seconds',
+    'Time to fetch the OIDC discovery document, by result (ok, error)',
+    ('result',))
+
+OIDC_REQUEST_SECONDS = histogram(
+    'jupyterhub_oidc_request_duration_seconds',
+    'Time of the requests and checks of a login, by operation (token, userinfo, id_token)',
+    ('operation',))
+
+SINGLE_FLIGHT_SHARED = counter(
+    'jupyterhub_single_flight_shared',
+    'Calls which waited for the result of the same call already in flight, by operation',
+    ('operation',))
+
+PRE_SPAWN_SECONDS = histogram(
+    'jupyterhub_pre_spawn_hook_duration_seconds',
+    'Time of the pre-spawn hook, by image name of allowed_images and result (ok, no_userinfo, error)',
+    ('image', 'result'))
@@ -1,323 +1,683 @@
-'''
-Descripttion: 
-version: 
-Author: Tao Chen
-Date: 2023-06-18 07:24:43
-LastEditors: Tao Chen
-LastEditTime: 2023-06-18 07:36:08
-'''
-#!/bin/python3
-from __future__ import annotations
-import logging
-from dataclasses import dataclass, field
-from AdUsers import *
-from typing import Any
-import yaml
-import os
-import sys
-current_folder = os.path.dirname(os.path.abspath(__file__))
-sys.path.append(current_folder)
-# -----
-
-# log = logging.getLogger(__name__)
-# logging.basicConfig(level=logging.DEBUG)
-# log.debug("groups: %s", groups)
-
-
-@dataclass
-class AiConfig:
-    enable: bool
-    name: str
-    key: str
-
-
-@dataclass
-class UserUpdate:
-    # If enabled is false, the uid and gid and username will be fetched from the container
-    enable: bool = False
-    # If from_ad is true, the uid and gid will be fetched from AD
-    # If from_ad is false, the uid and gid will be fetched 1000:1000
-    from_ad: bool = False
-    defualt_gid: int = 100
-    defualt_uid: int = 1000
-    default_group: str = 'users'
-
-
-@dataclass
-class ImageConfig:
-    name: str = None
-    image: str = None
-    allow_collab: bool = True
-
-    def from_dict(self, name: str, data: dict[str, str] | str):
-        """
-        return ImageConfig from dict
-        """
-        self.name = name
-        if isinstance(data, str):
-            self.image = data
-        elif isinstance(data, dict):
-            if 'image' in data:
-                self.image = data['image']
-            else:
-                raise Exception("image not found in image config")
-            if 'allow_collab' in data:
-                self.allow_collab = data['allow_collab']
-        else:
-            raise Exception("image config is not dict or str")
-
-
-@dataclass
-class ImageConfigMulti:
-    data: dict[str, ImageConfig] = field(default_factory=dict)
-
-    def from_dict(self, data: dict[str, dict[str, str]]):
-        """
-        return ImageConfigMulti from dict
-        """
-        self.data = {}
-        names = data.keys()
-        for name in names:
-            image_config = ImageConfig()
-            image_config.from_dict(name, data[name])
-            self.data[name] = image_config
-
-    def if_allow_collab_by_name(self, name: str) -> bool:
-        """
-        chech the designated image if allow collab
-        """
-        if name not in self.data:
-            return False
-        return self.data[name].allow_collab
-
-    def if_allow_collab_by_image(self, image: str) -> bool:
-        """
-        chech the designated image if allow collab
-        """
-        for name in self.data:
-            if self.data[name].image == image:
-                return self.data[name].allow_collab
-        return False
-
-    def allowed_images(self) -> dict[str, str]:
-        """
-        return allowed images
-        """
-        images = {}
-        for name in self.data:
-            images[name] = self.data[name].image
-        return images
-
-
-class MyConfig:
-    def __init__(self, filename: str = '/etc/jupyterhub/config.yaml'):
-        self.filename = filename
-        self.config: dict[str, Any] = {}
-        self.load()
-
-    def load(self, filename: str = None):
-        if filename is None:
-            filename = self.filename
-        with open(filename) as f:
-            self.config = yaml.safe_load(f)
-
-    def allowed_images(self) -> dict[str, str]:
-        """
-        return allowed images
-        """
-        images_config = self._read_image_config()
-        return images_config.allowed_images()
-
-    def load_groups(self) -> dict[dict[str, list[str]]]:
-        if 'groups' not in self.config:
-            return {}
-        return self.config['groups']
-
-    def load_roles(self) -> list[dict[str, dict[str, list[str]]], dict[str, list[str]]]:
-        """
-        load roles from config file
-        """
-        if 'roles' not in self.config:
-            return []
-        return self.config['roles']
-
-    def services(self) -> list[dict]:
-        if 'services' not in self.config:
-            return []
-        return self.config['services']
-
-    def _read_image_config(self) -> ImageConfigMulti:
-        if 'allowed_images' not in self.config:
-            return ImageConfigMulti()
-        images_config = ImageConfigMulti()
-        images_config.from_dict(self.config['allowed_images'])
-        return images_config
-
-    def user_source(self) -> UserUpdate:
-        if 'user_update' not in self.config:
-            return UserUpdate()
-        user = self.config['user_update']
-        return UserUpdate(enable=user['enable'],
-                          from_ad=user['from_ad'],
-                          defualt_uid=user['defualt_uid'],
-                          defualt_gid=user['defualt_gid'],
-                          default_group=user['default_group']
-                          )
-
-    @classmethod
-    def pre_spawn_hook_collab(cls, spawner):
-        """
-        execute before spawn for collab
-        """
-        group_names = {group.name for group in spawner.user.groups}
-        collab_enable_args = ['--LabApp.collaborative=True']
-        collab_disable_args = ['--LabApp.collaborative=False', '--YDocExtension.disable_rtc=True']
-        # '--YDocExtension.disable_rtc=False'
-        if "collaborative" in group_names:
-            spawner.log.info(f"Enabling RTC for user {spawner.user.name}")
-            cls.spawner_args_append_if_not_exist(spawner, collab_enable_args)
-        else:
-            spawner.log.info(f"Disabling RTC for user {spawner.user.name}")
-            cls.spawner_args_append_if_not_exist(spawner, collab_disable_args)
-
-    def ad(self) -> AdUser:
-        if 'ad' not in self.config or self.config['ad']['enable'] is not True:
-            return None
-        ad = self.config['ad']
-        ad_config = ad['config']
-        ldap_config = LdapConfig()
-        ldap_config.HOST = ad_config['host']
-        ldap_config.PORT = ad_config['port']
-        ldap_config.BASE_DN = ad_config['base_dn']
-        ldap_config.BIND_DN = ad_config['bind_dn']
-        ldap_config.BIND_PW = ad_config['bind_pw']
-        ldap_config.USER_BASE_RDN = ad_config['user_search_rdn']
-        ldap_config.GROUP_BASE_RDN = ad_config['group_search_rdn']
-        ldap_config.USER_FILTER = ad_config['user_search_filter']
-        ldap_config.USERNAME_ATTRIBUTE = ad_config['user_username_attribute']
-        if 'local_cache' not in ad or ad['local_cache']['enable'] is not True:
-            connect = '/tmp/ad_cache.sqlite3'
-            table = 'ad_cache'
-        else:
-            connect = ad['local_cache']['connect']
-            table = ad['local_cache']['table']
-        if "start_uid" in ad_config:
-            start_uid = ad_config["start_uid"]
-        else:
-            start_uid = None
-        user_sql = UserSql(connect)
-        # log.debug("connect",connect)
-        user_sql.table = table
-        ad_user = AdUser(ldap_config, user_sql, start_uid=start_uid)
-        if 'force_gid' in ad_config and ad_config['force_gid']['enable'] is True:
-            ad_user.force_gid = ad_config['force_gid']['gid']
-            ad_user.force_gname = ad_config['force_gid']['name']
-        if 'append_groups' in ad:
-            ad_user.append_groups = ad['append_groups']
-        if 'allow_users' in ad:
-            ad_user.allow_users = ad['allow_users']
-        return ad_user
-
-    def ai(self) -> AiConfig:
-        settting_name = 'ai'
-        if settting_name not in self.config or self.config[settting_name]['enable'] is not True:
-            return None
-        ai_config = self.config[settting_name]
-        ai_config = AiConfig(ai_config['enable'], ai_config['name'], ai_config['key'])
-        return ai_config
-
-    @classmethod
-    def spawner_args_append_if_not_exist(cls, spawner, args):
-        if args is None:
-            return
-        elif isinstance(args, str):
-            args = [args]
-        elif not isinstance(args, list):
-            return
-        for arg in args:
-            arg = arg.strip()
-            if arg not in spawner.args:
-                spawner.args.append(arg)
-
-
-def get_userinfo(spawner, ad_user: AdUser = None, user_source: UserUpdate = None) -> tuple[bool, UserInfo] | None:
-    """
-    Get user information from AD or local(1000,1000). If user_source is None, the user information will be fetched from the container
-
-    Returns:
-        bool: if the user information is from AD
-        UserInfo: user information
-    if user is not allowed, return None
-    """
-    if user_source is None:
-        from_ad = True
-    elif user_source.enable is False:
-        from_ad = False
-    else:
-        from_ad = user_source.from_ad
-    username = spawner.user.name
-    if ad_user is not None:
-        allow_users = ad_user.allow_users
-        if allow_users is not None and username not in allow_users:
-            return None
-    if from_ad:
-        try:
-            userinfo = ad_user.user_check(username)
-            return True, userinfo
-        except Exception as e:
-            spawner.log.error(f"User {username} not found in AD")
-            spawner.notebook_dir = '/home/jovyan'
-            spawner.log.error(e)
-            return None
-    else:
-        userinfo = UserInfo(username=username)
-        userinfo.uid = user_source.defualt_uid
-        userinfo.gid = user_source.defualt_gid
-        userinfo.groupname = user_source.default_group
-    return False, userinfo
-
-
-def config_user(spawner, ad_user: AdUser = None, user_source: UserUpdate = None, append_groups: list[str] = None):
-    """
-    Config user's uid, gid and home directory from AD informatin. this is because we mount the user's home directory to the host
-    """
-    from_ad, userinfo = get_userinfo(spawner, ad_user, user_source)
-    if userinfo is None:
-        return
-    spawner.extra_create_kwargs.update({'user': 'root'})
-    spawner.extra_create_kwargs.update({'working_dir': '/home/'+userinfo.username})
-    spawner.environment['CHOWN_HOME'] = 'no'
-    spawner.environment['CHOWN_HOME_OPTS'] = ''
-    spawner.environment['NB_UID'] = userinfo.uid
-    spawner.environment['NB_GID'] = userinfo.gid
-    spawner.environment['NB_USER'] = userinfo.username
-    spawner.environment['NB_GROUP'] = userinfo.groupname
-    if from_ad:
-        spawner.environment["GIT_AUTHOR_NAME"] = userinfo.cn
-        spawner.environment["GIT_COMMITTER_NAME"] = userinfo.cn
-        spawner.environment["GIT_AUTHOR_EMAIL"] = userinfo.mail
-        spawner.environment["GIT_COMMITTER_EMAIL"] = userinfo.mail
-    return
-
-
-def config_ai(spawner, ai_config: AiConfig = None):
-    if ai_config is None:
-        return
-    spawner.environment[ai_config.name] = ai_config.key
-
-
-def my_pre_spawn_hook(spawner):
-    CONFIG_FILE = os.getenv('CONFIG_FILE', '/etc/jupyterhub/config.yaml')
-    my_config = MyConfig(filename=CONFIG_FILE)
-    ad_user = my_config.ad()
-    user_source = my_config.user_source()
-    config_user(spawner=spawner, ad_user=ad_user, user_source=user_source)
-    config_ai(spawner, my_config.ai())
-    image_name = spawner.image
-    image_config = my_config._read_image_config()
-    if image_config.if_allow_collab_by_image(image_name):
-        MyConfig.pre_spawn_hook_collab(spawner)
-
-
-if __name__ == "__main__":
-    config = MyConfig(filename='./config.yaml')
+'''
+Descripttion: 
+version: 
+Author: Tao Chen
+Date: 2023-06-18 07:24:43
+LastEditors: Tao Chen
+LastEditTime: 2023-06-18 07:36:08
+'''
+#!/bin/python3
+from __future__ import annotations
+import logging
+from dataclasses import dataclass, field
+from AdUsers import *
+from Metrics import CONFIG_LOAD_SECONDS, PRE_SPAWN_SECONDS
+from typing import Any
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import threading
+import time
+import yaml
+import os
+import sys
+current_folder = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_folder)
+# -----
+
+# log = logging.getLogger(__name__)
+# logging.basicConfig(level=logging.DEBUG)
+# log.debug("groups: %s", groups)
+
+
+@dataclass
+class AiConfig:
+    enable: bool
+    name: str
+    key: str
+
+
+@dataclass
+class UserUpdate:
+    # If enabled is false, the uid and gid and username will be fetched from the container
+    enable: bool = False
+    # If from_ad is true, the uid and gid will be fetched from AD
+    # If from_ad is false, the uid and gid will be fetched 1000:1000
+    from_ad: bool = False
+    defualt_gid: int = 100
+    defualt_uid: int = 1000
+    default_group: str = 'users'
+
+
+@dataclass
+class HookConfig:
+    # number of threads running the blocking AD and cache lookups of the pre-spawn hook
+    max_workers: int = 8
+    # seconds to wait for the user lookup before the spawn continues without it
+    timeout: float = 30
+
+
+@dataclass
+class ImageConfig:
+    name: str = None
+    image: str = None
+    allow_collab: bool = True
+
+    def from_dict(self, name: str, data: dict[str, str] | str):
+        """
+        return ImageConfig from dict
+        """
+        self.name = name
+        if isinstance(data, str):
+            self.image = data
+        elif isinstance(data, dict):
+            if 'image' in data:
+                self.image = data['image']
+            else:
+                raise Exception("image not found in image config")
+            if 'allow_collab' in data:
+                self.allow_collab = data['allow_collab']
+        else:
+            raise Exception("image config is not dict or str")
+
+
+@dataclass
+class ImageConfigMulti:
+    data: dict[str, ImageConfig] = field(default_factory=dict)
+    # image -> ImageConfig, the first name of an image wins
+    by_image: dict[str, ImageConfig] = field(default_factory=dict, repr=False)
+
+    def from_dict(self, data: dict[str, dict[str, str]]):
+        """
+        return ImageConfigMulti from dict
+        """
+        self.data = {}
+        self.by_image = {}
+        names = data.keys()
+        for name in names:
+            image_config = ImageConfig()
+            image_config.from_dict(name, data[name])
+            self.data[name] = image_config
+            self.by_image.setdefault(image_config.image, image_config)
+
+    def get(self, name_or_image: str) -> ImageConfig | None:
+        """
+        the ImageConfig of a name of allowed_images, or of an image
+        """
+        if name_or_image in self.data:
+            return self.data[name_or_image]
+        return self.by_image.get(name_or_image)
+
+    def if_allow_collab_by_name(self, name: str) -> bool:
+        """
+        chech the designated image if allow collab
+        """
+        if name not in self.data:
+            return False
+        return self.data[name].allow_collab
+
+    def if_allow_collab_by_image(self, image: str) -> bool:
+        """
+        chech the designated image if allow collab
+        """
+        image_config = self.by_image.get(image)
+        if image_config is None:
+            return False
+        return image_config.allow_collab
+
+    def allowed_images(self) -> dict[str, str]:
+        """
+        return allowed images
+        """
+        images = {}
+        for name in self.data:
+            images[name] = self.data[name].image
+        return images
+
+
+class MyConfig:
+    # process-wide snapshots, see MyConfig.snapshot
+    _snapshots: dict[str, ConfigSnapshot] = {}
+    _snapshot_lock = threading.Lock()
+
+    def __init__(self, filename: str = '/etc/jupyterhub/config.yaml', content: bytes = None):
+        self.filename = filename
+        self.config: dict[str, Any] = {}
+        self.version: str = None
+        if content is None:
+            self.load()
+        else:
+            self.load_content(content)
+
+    def load(self, filename: str = None):
+        if filename is None:
+            filename = self.filename
+        with open(filename, 'rb') as f:
+            content = f.read()
+        self.load_content(content)
+
+    def load_content(self, content: bytes):
+        """
+        parse the content of config.yaml. version is the sha256 of the content
+        """
+        start = time.perf_counter()
+        self.config = yaml.safe_load(content) or {}
+        self.version = hashlib.sha256(content).hexdigest()
+        CONFIG_LOAD_SECONDS.observe(time.perf_counter() - start)
+
+    @classmethod
+    def snapshot(cls, filename: str = '/etc/jupyterhub/config.yaml') -> ConfigSnapshot:
+        """
+        return the shared snapshot of filename.\n
+        The file is only read again when its inode, mtime or size changes, and the derived objects are only
+        rebuilt when the content hash changes as well.
+        """
+        stat = os.stat(filename)
+        stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        snapshot = cls._snapshots.get(filename)
+        if snapshot is not None and snapshot.stat_key == stat_key:
+            return snapshot
+        with cls._snapshot_lock:
+            snapshot = cls._snapshots.get(filename)
+            if snapshot is not None and snapshot.stat_key == stat_key:
+                return snapshot
+            with open(filename, 'rb') as f:
+                content = f.read()
+            version = hashlib.sha256(content).hexdigest()
+            if snapshot is not None and snapshot.version == version:
+                # touched but not changed
+                snapshot.stat_key = stat_key
+                return snapshot
+            my_config = cls(filename=filename, content=content)
+            old_snapshot = snapshot
+            snapshot = ConfigSnapshot.from_config(my_config, stat_key)
+            cls._snapshots[filename] = snapshot
+            if old_snapshot is not None:
+                old_snapshot.close()
+            return snapshot
+
+    def allowed_images(self) -> dict[str, str]:
+        """
+        return allowed images
+        """
+        images_config = self._read_image_config()
+        return images_config.allowed_images()
+
+    def load_groups(self) -> dict[dict[str, list[str]]]:
+        if 'groups' not in self.config:
+            return {}
+        return self.config['groups']
+
+    def load_roles(self) -> list[dict[str, dict[str, list[str]]], dict[str, list[str]]]:
+        """
+        load roles from config file
+        """
+        if 'roles' not in self.config:
+            return []
+        return self.config['roles']
+
+    def services(self) -> list[dict]:
+        if 'services' not in self.config:
+            return []
+        return self.config['services']
+
+    def _read_image_config(self) -> ImageConfigMulti:
+        if 'allowed_images' not in self.config:
+            return ImageConfigMulti()
+        images_config = ImageConfigMulti()
+        images_config.from_dict(self.config['allowed_images'])
+        return images_config
+
+    def user_source(self) -> UserUpdate:
+        if 'user_update' not in self.config:
+            return UserUpdate()
+        user = self.config['user_update']
+        return UserUpdate(enable=user['enable'],
+                          from_ad=user['from_ad'],
+                          defualt_uid=user['defualt_uid'],
+                          defualt_gid=user['defualt_gid'],
+                          default_group=user['default_group']
+                          )
+
+    collab_group = "collaborative"
+    collab_enable_args = ('--LabApp.collaborative=True',)
+    collab_disable_args = ('--LabApp.collaborative=False', '--YDocExtension.disable_rtc=True')
+
+    @classmethod
+    def in_collab_group(cls, spawner) -> bool:
+        return any(group.name == cls.collab_group for group in spawner.user.groups)
+
+    @classmethod
+    def pre_spawn_hook_collab(cls, spawner):
+        """
+        execute before spawn for collab
+        """
+        collab_enable_args = list(cls.collab_enable_args)
+        collab_disable_args = list(cls.collab_disable_args)
+        # '--YDocExtension.disable_rtc=False'
+        if cls.in_collab_group(spawner):
+            spawner.log.info(f"Enabling RTC for user {spawner.user.name}")
+            cls.spawner_args_append_if_not_exist(spawner, collab_enable_args)
+        else:
+            spawner.log.info(f"Disabling RTC for user {spawner.user.name}")
+            cls.spawner_args_append_if_not_exist(spawner, collab_disable_args)
+
+    def spawn_hook(self) -> HookConfig:
+        if 'spawn_hook' not in self.config:
+            return HookConfig()
+        hook = self.config['spawn_hook']
+        hook_config = HookConfig()
+        if 'max_workers' in hook:
+            hook_config.max_workers = hook['max_workers']
+        if 'timeout' in hook:
+            hook_config.timeout = hook['timeout']
+        return hook_config
+
+    def ad(self) -> AdUser:
+        if 'ad' not in self.config or self.config['ad']['enable'] is not True:
+            return None
+        ad = self.config['ad']
+        ad_config = ad['config']
+        ldap_config = LdapConfig()
+        ldap_config.HOST = ad_config['host']
+        ldap_config.PORT = ad_config['port']
+        ldap_config.BASE_DN = ad_config['base_dn']
+        ldap_config.BIND_DN = ad_config['bind_dn']
+        ldap_config.BIND_PW = ad_config['bind_pw']
+        ldap_config.USER_BASE_RDN = ad_config['user_search_rdn']
+        ldap_config.GROUP_BASE_RDN = ad_config['group_search_rdn']
+        ldap_config.USER_FILTER = ad_config['user_search_filter']
+        ldap_config.USERNAME_ATTRIBUTE = ad_config['user_username_attribute']
+        if 'page_size' in ad_config:
+            ldap_config.PAGE_SIZE = ad_config['page_size']
+        if 'schema_cache' in ad_config:
+            ldap_config.SCHEMA_CACHE_DIR = ad_config['schema_cache'].get('dir', '/data/ldap_schema')
+            ldap_config.SCHEMA_REFRESH = ad_config['schema_cache'].get('refresh', False)
+        if 'local_cache' not in ad or ad['local_cache']['enable'] is not True:
+            connect = '/tmp/ad_cache.sqlite3'
+            table = 'ad_cache'
+        else:
+            connect = ad['local_cache']['connect']
+            table = ad['local_cache']['table']
+        if "start_uid" in ad_config:
+            start_uid = ad_config["start_uid"]
+        else:
+            start_uid = None
+        user_sql = UserSql(connect)
+        # log.debug("connect",connect)
+        user_sql.table = table
+        if 'local_cache' in ad:
+            user_sql.max_age = ad['local_cache'].get('max_age', user_sql.max_age)
+            user_sql.hard_max_age = ad['local_cache'].get('hard_max_age', user_sql.hard_max_age)
+        ad_user = AdUser(ldap_config, user_sql, start_uid=start_uid)
+        if 'force_gid' in ad_config and ad_config['force_gid']['enable'] is True:
+            ad_user.force_gid = ad_config['force_gid']['gid']
+            ad_user.force_gname = ad_config['force_gid']['name']
+        if 'append_groups' in ad:
+            ad_user.append_groups = ad['append_groups']
+        if 'allow_users' in ad:
+            ad_user.allow_users = ad['allow_users']
+        if 'pool' in ad:
+            pool = ad['pool']
+            pool_config = PoolConfig()
+            for key in ('max_size', 'idle_timeout', 'check_interval', 'timeout'):
+                if key in pool:
+                    setattr(pool_config, key, pool[key])
+            ad_user.pool_config = pool_config
+        if 'async_ldap' in ad:
+            async_ldap = ad['async_ldap']
+            for key in ('enable', 'connections', 'max_outstanding', 'timeout'):
+                if key in async_ldap:
+                    setattr(ad_user.async_config, key, async_ldap[key])
+        if 'preload' in ad:
+            preload = ad['preload']
+            for key in ('enable', 'progress_every', 'chunk_size', 'max_workers'):
+                if key in preload:
+                    setattr(ad_user.preload_config, key, preload[key])
+        if 'memory_cache' in ad:
+            memory_cache = ad['memory_cache']
+            for key in ('enable', 'max_size', 'ttl', 'negative_ttl'):
+                if key in memory_cache:
+                    setattr(ad_user.cache_config, key, memory_cache[key])
+        if 'sync' in ad:
+            sync = ad['sync']
+            for key in ('enable', 'interval', 'jitter', 'mode', 'status_file', 'reconcile_interval', 'tombstones'):
+                if key in sync:
+                    setattr(ad_user.sync_config, key, sync[key])
+        return ad_user
+
+    def ai(self) -> AiConfig:
+        settting_name = 'ai'
+        if settting_name not in self.config or self.config[settting_name]['enable'] is not True:
+            return None
+        ai_config = self.config[settting_name]
+        ai_config = AiConfig(ai_config['enable'], ai_config['name'], ai_config['key'])
+        return ai_config
+
+    @classmethod
+    def spawner_args_append_if_not_exist(cls, spawner, args):
+        if args is None:
+            return
+        elif isinstance(args, str):
+            args = [args]
+        elif not isinstance(args, (list, tuple)):
+            return
+        existing = set(spawner.args)
+        for arg in args:
+            arg = arg.strip()
+            if arg not in existing:
+                spawner.args.append(arg)
+                existing.add(arg)
+
+
+@dataclass
+class SpawnPlan:
+    """
+    What the pre-spawn hook sets on a spawner. It only depends on the user info, the image, the collab group
+    and the config, so it is computed once and shared by the spawns (and named servers) of a user.
+    """
+    environment: dict[str, Any] = field(default_factory=dict)
+    create_kwargs: dict[str, Any] = field(default_factory=dict)
+    args: tuple[str, ...] = ()
+    # None if the image does not allow collab, otherwise if RTC is enabled
+    collab: bool = None
+
+    def add_userinfo(self, result: tuple[bool, UserInfo] | None):
+        """
+        the container user and environment from the result of get_userinfo
+        """
+        if result is None:
+            return
+        from_ad, userinfo = result
+        if userinfo is None:
+            return
+        self.create_kwargs['user'] = 'root'
+        self.create_kwargs['working_dir'] = '/home/'+userinfo.username
+        self.environment['CHOWN_HOME'] = 'no'
+        self.environment['CHOWN_HOME_OPTS'] = ''
+        self.environment['NB_UID'] = userinfo.uid
+        self.environment['NB_GID'] = userinfo.gid
+        self.environment['NB_USER'] = userinfo.username
+        self.environment['NB_GROUP'] = userinfo.groupname
+        if from_ad:
+            self.environment["GIT_AUTHOR_NAME"] = userinfo.cn
+            self.environment["GIT_COMMITTER_NAME"] = userinfo.cn
+            self.environment["GIT_AUTHOR_EMAIL"] = userinfo.mail
+            self.environment["GIT_COMMITTER_EMAIL"] = userinfo.mail
+
+    def add_ai(self, ai_config: AiConfig = None):
+        if ai_config is None:
+            return
+        self.environment[ai_config.name] = ai_config.key
+
+    def add_collab(self, collab: bool = None):
+        self.collab = collab
+        if collab is True:
+            self.args = MyConfig.collab_enable_args
+        elif collab is False:
+            self.args = MyConfig.collab_disable_args
+
+    def apply(self, spawner):
+        """
+        set the plan on spawner. The dicts are copied, plans are shared between spawners.
+        """
+        spawner.extra_create_kwargs.update(self.create_kwargs)
+        spawner.environment.update(self.environment)
+        if self.collab is True:
+            spawner.log.info(f"Enabling RTC for user {spawner.user.name}")
+        elif self.collab is False:
+            spawner.log.info(f"Disabling RTC for user {spawner.user.name}")
+        MyConfig.spawner_args_append_if_not_exist(spawner, self.args)
+
+
+@dataclass
+class ConfigSnapshot:
+    """
+    A parsed config.yaml and the objects derived from it. Built once per version of the file and shared by all spawns.
+    """
+    config: MyConfig
+    stat_key: tuple = None
+    ad_user: AdUser = None
+    user_source: UserUpdate = None
+    ai: AiConfig = None
+    image_config: ImageConfigMulti = None
+    hook: HookConfig = field(default_factory=HookConfig)
+    _executor: ThreadPoolExecutor = field(default=None, repr=False)
+    _executor_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    # set by close, the snapshot may still be used by the hooks which started before
+    closed: bool = False
+    # spawn plans of this config version, see spawn_plan
+    _plans: OrderedDict = field(default_factory=OrderedDict, repr=False)
+    _plans_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    max_plans: int = 4096
+
+    @property
+    def version(self) -> str:
+        return self.config.version
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """
+        bounded thread pool for the blocking work of the pre-spawn hook.\n
+        None once the snapshot is closed, a hook which still holds it uses the default executor of the loop,
+        a new pool would never be shut down.
+        """
+        with self._executor_lock:
+            if self._executor is None and not self.closed:
+                self._executor = ThreadPoolExecutor(max_workers=self.hook.max_workers, thread_name_prefix='pre-spawn')
+            return self._executor
+
+    def close(self):
+        """
+        release the thread pools. Running lookups are allowed to finish.
+        """
+        with self._executor_lock:
+            self.closed = True
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+        if self.ad_user is not None:
+            self.ad_user.close()
+
+    def spawn_plan(self, spawner, result: tuple[bool, UserInfo] | None) -> SpawnPlan:
+        """
+        the SpawnPlan of spawner, memoized by user, image, user info and collab group.
+        The image is the one selected in the spawn form, spawner.image is only set from it in start().
+        """
+        image = spawner.user_options.get('image') or spawner.image
+        image_config = self.image_config.get(image) if self.image_config is not None else None
+        collab = None
+        if image_config is not None and image_config.allow_collab:
+            collab = MyConfig.in_collab_group(spawner)
+        if result is None or result[1] is None:
+            userinfo_key = None
+        else:
+            userinfo_key = (result[0], result[1].key())
+        key = (spawner.user.name, image, userinfo_key, collab)
+        with self._plans_lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+        plan = SpawnPlan()
+        plan.add_userinfo(result)
+        plan.add_ai(self.ai)
+        plan.add_collab(collab)
+        with self._plans_lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    @classmethod
+    def from_config(cls, my_config: MyConfig, stat_key: tuple = None) -> ConfigSnapshot:
+        return cls(config=my_config,
+                   stat_key=stat_key,
+                   ad_user=my_config.ad(),
+                   user_source=my_config.user_source(),
+                   ai=my_config.ai(),
+                   image_config=my_config._read_image_config(),
+                   hook=my_config.spawn_hook())
+
+
+def get_userinfo(spawner, ad_user: AdUser = None, user_source: UserUpdate = None) -> tuple[bool, UserInfo] | None:
+    """
+    Get user information from AD or local(1000,1000). If user_source is None, the user information will be fetched from the container
+
+    Returns:
+        bool: if the user information is from AD
+        UserInfo: user information
+    if user is not allowed, return None
+    """
+    from_ad = _userinfo_from_ad(user_source)
+    username = spawner.user.name
+    if not _user_allowed(ad_user, username):
+        return None
+    if from_ad:
+        try:
+            userinfo = ad_user.user_check(username)
+            return True, userinfo
+        except Exception as e:
+            _userinfo_failed(spawner, username, e)
+            return None
+    return False, _default_userinfo(username, user_source)
+
+
+async def get_userinfo_async(spawner, ad_user: AdUser = None, user_source: UserUpdate = None,
+                             executor: ThreadPoolExecutor = None, timeout: float = None) -> tuple[bool, UserInfo] | None:
+    """
+    Same as get_userinfo, but the AD lookup runs on executor so it does not block the event loop,
+    or on the event loop itself with ad.async_ldap.\n
+    If the lookup takes longer than timeout seconds, it is treated like a failed lookup.
+    """
+    from_ad = _userinfo_from_ad(user_source)
+    username = spawner.user.name
+    if not _user_allowed(ad_user, username):
+        return None
+    if from_ad:
+        try:
+            if ad_user.async_config.enable:
+                future = ad_user.user_check_async(username)
+            else:
+                future = asyncio.get_running_loop().run_in_executor(executor, ad_user.user_check, username)
+            userinfo = await asyncio.wait_for(future, timeout)
+            return True, userinfo
+        except asyncio.TimeoutError:
+            _userinfo_failed(spawner, username, f"lookup timed out after {timeout}s")
+            return None
+        except Exception as e:
+            _userinfo_failed(spawner, username, e)
+            return None
+    return False, _default_userinfo(username, user_source)
+
+
+def _userinfo_from_ad(user_source: UserUpdate = None) -> bool:
+    if user_source is None:
+        return True
+    elif user_source.enable is False:
+        return False
+    return user_source.from_ad
+
+
+def _user_allowed(ad_user: AdUser, username: str) -> bool:
+    if ad_user is None:
+        return True
+    allow_users = ad_user.allow_users
+    return allow_users is None or username in allow_users
+
+
+def _userinfo_failed(spawner, username: str, error):
+    spawner.log.error(f"User {username} not found in AD")
+    spawner.notebook_dir = '/home/jovyan'
+    spawner.log.error(error)
+
+
+def _default_userinfo(username: str, user_source: UserUpdate) -> UserInfo:
+    userinfo = UserInfo(username=username)
+    userinfo.uid = user_source.defualt_uid
+    userinfo.gid = user_source.defualt_gid
+    userinfo.groupname = user_source.default_group
+    return userinfo
+
+
+def config_user(spawner, ad_user: AdUser = None, user_source: UserUpdate = None, append_groups: list[str] = None):
+    """
+    Config user's uid, gid and home directory from AD informatin. this is because we mount the user's home directory to the host
+    """
+    result = get_userinfo(spawner, ad_user, user_source)
+    apply_userinfo(spawner, result)
+
+
+async def config_user_async(spawner, ad_user: AdUser = None, user_source: UserUpdate = None,
+                            executor: ThreadPoolExecutor = None, timeout: float = None):
+    """
+    Same as config_user, with the AD lookup done by get_userinfo_async
+    """
+    result = await get_userinfo_async(spawner, ad_user, user_source, executor=executor, timeout=timeout)
+    apply_userinfo(spawner, result)
+
+
+def apply_userinfo(spawner, result: tuple[bool, UserInfo] | None):
+    """
+    Set the container user and environment from the result of get_userinfo
+    """
+    plan = SpawnPlan()
+    plan.add_userinfo(result)
+    plan.apply(spawner)
+
+
+def config_ai(spawner, ai_config: AiConfig = None):
+    if ai_config is None:
+        return
+    spawner.environment[ai_config.name] = ai_config.key
+
+
+def _image_label(spawner, snapshot: ConfigSnapshot) -> str:
+    """
+    the name of the image in allowed_images, a bounded label for the metrics
+    """
+    image = spawner.user_options.get('image')
+    if image is None:
+        return 'default'
+    image_config = snapshot.image_config.get(image) if snapshot.image_config is not None else None
+    return 'other' if image_config is None else image_config.name
+
+
+def _observe_pre_spawn(spawner, snapshot: ConfigSnapshot, result: str, start: float):
+    PRE_SPAWN_SECONDS.labels(_image_label(spawner, snapshot), result).observe(time.perf_counter() - start)
+
+
+def my_pre_spawn_hook(spawner):
+    start = time.perf_counter()
+    CONFIG_FILE = os.getenv('CONFIG_FILE', '/etc/jupyterhub/config.yaml')
+    snapshot = MyConfig.snapshot(CONFIG_FILE)
+    try:
+        result = get_userinfo(spawner, snapshot.ad_user, snapshot.user_source)
+        snapshot.spawn_plan(spawner, result).apply(spawner)
+    except Exception:
+        _observe_pre_spawn(spawner, snapshot, 'error', start)
+        raise
+    _observe_pre_spawn(spawner, snapshot, 'no_userinfo' if result is None else 'ok', start)
+
+
+async def my_pre_spawn_hook_async(spawner):
+    """
+    my_pre_spawn_hook without blocking the hub's event loop: the AD and cache lookups run on a bounded thread pool
+    with a timeout, see spawn_hook in config.yaml
+    """
+    start = time.perf_counter()
+    CONFIG_FILE = os.getenv('CONFIG_FILE', '/etc/jupyterhub/config.yaml')
+    snapshot = MyConfig.snapshot(CONFIG_FILE)
+    try:
+        result = await get_userinfo_async(spawner, snapshot.ad_user, snapshot.user_source,
+                                          executor=snapshot.executor, timeout=snapshot.hook.timeout)
+        snapshot.spawn_plan(spawner, result).apply(spawner)
+    except Exception:
+        _observe_pre_spawn(spawner, snapshot, 'error', start)
+        raise
+    _observe_pre_spawn(spawner, snapshot, 'no_userinfo' if result is None else 'ok', start)
+
+
+if __name__ == "__main__":
+    config = MyConfig(filename='./config.yaml')
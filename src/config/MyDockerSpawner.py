@@ -1,6 +1,16 @@
 from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
 from dockerspawner import DockerSpawner
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
+from docker.utils import kwargs_from_env
+from traitlets import Bool
+from typing import Callable
+import asyncio
+import docker
+import json
+import logging
+import os
+import time
 
 
 @dataclass
@@ -46,10 +56,297 @@ class MultiForm:
                 else:
                     setattr(self, key, data_dict[key])
 
+@dataclass
+class ImageStatus:
+    image: str
+    # pending, pulling, ready or failed
+    state: str = 'pending'
+    # repo@sha256:... once ready, None for images without a registry digest
+    digest: str = None
+    progress: str = None
+    error: str = None
+    attempts: int = 0
+    updated: float = None
+
+
+class ImagePrePuller:
+    """
+    Pull the allowed images in the background of the hub, so that no user waits for a pull.\n
+    get_images is called every interval seconds, new images and images whose pull failed are pulled,
+    at most concurrency at a time. A failed pull is retried retries times with an exponential backoff.
+    Ready images are checked again, an image removed from the host is pulled again, and the digest of a moved tag is updated.
+    Ready images are pinned to their digest, see resolve.
+    """
+
+    def __init__(self, get_images: Callable[[], dict[str, str] | list[str]], concurrency: int = 2, retries: int = 3,
+                 backoff: float = 10, interval: float = 300, status_file: str = None,
+                 client_factory: Callable[[], docker.APIClient] = None, log: logging.Logger = None) -> None:
+        self.get_images = get_images
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.interval = interval
+        self.status_file = status_file
+        self.client_factory = client_factory or self._default_client
+        self.log = log or logging.getLogger('JupyterHub.image_pull')
+        self.status: dict[str, ImageStatus] = {}
+        self._client: docker.APIClient = None
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='image-pull')
+        self._semaphore: asyncio.Semaphore = None
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._task: asyncio.Task = None
+
+    @classmethod
+    def _default_client(cls) -> docker.APIClient:
+        return docker.APIClient(version='auto', **kwargs_from_env())
+
+    @property
+    def client(self) -> docker.APIClient:
+        if self._client is None:
+            self._client = self.client_factory()
+        return self._client
+
+    def start(self) -> bool:
+        """
+        start pulling on the running event loop. Return False if there is no running loop.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.log.warning("No running event loop, the images are not pre-pulled")
+            return False
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        return True
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in self._tasks.values():
+            task.cancel()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @classmethod
+    def images_of(cls, images: dict[str, str] | list[str] | None) -> list[str]:
+        if images is None or images == '*':
+            return []
+        if isinstance(images, dict):
+            return list(images.values())
+        return list(images)
+
+    async def _run(self):
+        while True:
+            try:
+                self.check(self.get_images(), recheck=True)
+            except Exception as e:
+                self.log.error("Cannot read the allowed images: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def check(self, images: dict[str, str] | list[str] | None, recheck: bool = False):
+        """
+        start a pull of each image that is not ready and not being pulled, with recheck also of the ready images
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        for image in self.images_of(images):
+            status = self.status.get(image)
+            if status is not None and status.state == 'ready' and not recheck:
+                continue
+            task = self._tasks.get(image)
+            if task is None or task.done():
+                self._tasks[image] = asyncio.ensure_future(self.pull(image))
+
+    async def pull(self, image: str) -> bool:
+        """
+        pull image, retried with backoff. Return True if the image is ready.
+        """
+        status = self.status.setdefault(image, ImageStatus(image=image))
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            async with self._semaphore:
+                # a ready image stays usable while it is checked again
+                digest = status.digest if status.state == 'ready' else None
+                if digest is None:
+                    status.state = 'pulling'
+                status.attempts += 1
+                status.updated = time.time()
+                start = time.monotonic()
+                try:
+                    status.digest = await loop.run_in_executor(self._executor, self._pull, status)
+                except Exception as e:
+                    status.state = 'failed'
+                    status.error = f"{type(e).__name__}: {e}"
+                    self.log.warning("Pull of %s failed (attempt %d): %s", image, status.attempts, status.error)
+                else:
+                    status.state = 'ready'
+                    status.error = None
+                    status.progress = None
+                    if status.digest != digest:
+                        self.log.info("Image %s is ready (%s) after %.1fs", image, status.digest or 'no digest', time.monotonic() - start)
+                finally:
+                    status.updated = time.time()
+                    self.write_status()
+            if status.state == 'ready':
+                return True
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        # pulled again on the next check
+        return False
+
+    @classmethod
+    def split(cls, image: str) -> tuple[str, str]:
+        """
+        repo and tag of image, like DockerSpawner.pull_image
+        """
+        if '@' in image:
+            return image.split('@', 1)[0], None
+        if ':' in image.split("/")[-1]:
+            return tuple(image.rsplit(':', 1))
+        return image, 'latest'
+
+    def _pull(self, status: ImageStatus) -> str | None:
+        """
+        pull status.image if it is not present (blocking), return its digest
+        """
+        client = self.client
+        try:
+            info = client.inspect_image(status.image)
+        except docker.errors.NotFound:
+            status.state = 'pulling'
+            repo, tag = self.split(status.image)
+            layers: dict[str, str] = {}
+            last_report = 0
+            for event in client.pull(repo, tag=tag, stream=True, decode=True):
+                if 'error' in event:
+                    raise docker.errors.APIError(event['error'])
+                if 'id' in event and 'status' in event:
+                    layers[event['id']] = event['status']
+                done = sum(1 for state in layers.values() if state in ('Pull complete', 'Already exists'))
+                status.progress = f"{done}/{len(layers)} layers"
+                if time.monotonic() - last_report > 10:
+                    last_report = time.monotonic()
+                    self.log.info("Pulling %s: %s", status.image, status.progress)
+            info = client.inspect_image(status.image)
+        return self.digest_of(status.image, info)
+
+    @classmethod
+    def digest_of(cls, image: str, info: dict) -> str | None:
+        """
+        the repo@digest of image in the inspect_image result info, None if the image was not pulled from a registry
+        """
+        repo, _ = cls.split(image)
+        digests = info.get('RepoDigests') or []
+        for digest in digests:
+            if digest.split('@', 1)[0] == repo:
+                return digest
+        # docker hub images are listed without docker.io/ or library/
+        return digests[0] if len(digests) == 1 else None
+
+    def ready(self, image: str) -> bool:
+        status = self.status.get(image)
+        return status is not None and status.state == 'ready'
+
+    def resolve(self, image: str) -> str:
+        """
+        the pinned digest of image if it is ready, otherwise image
+        """
+        status = self.status.get(image)
+        if status is None or status.state != 'ready' or status.digest is None:
+            return image
+        return status.digest
+
+    def is_pinned(self, image: str) -> bool:
+        """
+        whether image is a digest returned by resolve
+        """
+        return any(status.digest == image for status in self.status.values())
+
+    def status_dict(self) -> dict:
+        return {image: asdict(status) for image, status in self.status.items()}
+
+    def write_status(self):
+        """
+        write the status as json to status_file
+        """
+        if self.status_file is None:
+            return
+        try:
+            with open(self.status_file + '.tmp', 'w') as f:
+                json.dump(self.status_dict(), f, indent=2)
+            os.replace(self.status_file + '.tmp', self.status_file)
+        except OSError as e:
+            self.log.warning("Cannot write the image status to %s: %s", self.status_file, e)
+
+
 # # https://github.com/manics/zero-to-jupyterhub-k8s-examples/tree/main/ldap-singleuser
 class MyDockerSpawner(DockerSpawner):
     # ad_user = None
-    pass
+    # set in jupyterhub_config.py, shared by all spawners
+    image_puller: ImagePrePuller = None
+
+    hide_unready_images = Bool(
+        False,
+        config=True,
+        help="""
+        Offer only the allowed images which are pulled already, if image_puller is set.
+        If none of them is ready, all are offered.
+        """,
+    )
+
+    def _get_allowed_images(self):
+        allowed_images = super()._get_allowed_images()
+        puller = self.image_puller
+        if puller is None or not isinstance(allowed_images, dict):
+            return allowed_images
+        if puller.running:
+            # images new in config.yaml are pulled now, not on the next check
+            puller.check(allowed_images)
+        if self.hide_unready_images:
+            ready = {name: image for name, image in allowed_images.items() if puller.ready(image)}
+            if len(ready) > 0:
+                return ready
+        return allowed_images
+
+    @property
+    def pins_images(self) -> bool:
+        """
+        whether images are pinned to the digests of image_puller. pull_policy always wants the tag pulled again.
+        """
+        return self.image_puller is not None and self.pull_policy.lower() != 'always'
+
+    async def check_allowed(self, image):
+        """
+        the allowed image, pinned to its digest once pulled by image_puller
+        """
+        image = await super().check_allowed(image)
+        if self.pins_images:
+            image = self.image_puller.resolve(image)
+        return image
+
+    async def start(self):
+        if self.pins_images and not self.user_options.get('image'):
+            self.image = self.image_puller.resolve(self.image)
+        return await super().start()
+
+    async def pull_image(self, image):
+        """
+        DockerSpawner.pull_image, which can not split a pinned repo@sha256:... into repo and tag.
+        A pinned image is checked on this host like any image, and pulled by its digest if it was removed.
+        """
+        if self.image_puller is None or not self.image_puller.is_pinned(image) or self.pull_policy == 'skip':
+            return await super().pull_image(image)
+        try:
+            await self.docker('inspect_image', image)
+        except docker.errors.NotFound:
+            if self.pull_policy == 'never':
+                raise
+            repo, digest = image.split('@', 1)
+            self.log.info("pulling image %s", image)
+            await self.docker('pull', repo, digest)
     # def __init__(self, *args, **kwargs):
     #     super().__init__(*args, **kwargs)
     #     self.ad_user = None
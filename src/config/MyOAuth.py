@@ -1,24 +1,48 @@
 from __future__ import annotations
 import os
 from oauthenticator.generic import GenericOAuthenticator
-from traitlets import Bool, Dict, Set, Unicode, Union, default
+from oauthenticator.oauth2 import OAuthLoginHandler
+from traitlets import Bool, Dict, Float, List, Set, Unicode, Union, default, observe
 from jupyterhub.traitlets import Callable
 import re
-from tornado import gen
+from tornado import web
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
 from urllib.parse import urlparse
 import requests
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+import asyncio
+import json
+import threading
+import time
 
 import logging
+import jwt
+from Metrics import OIDC_DISCOVERY_SECONDS, OIDC_REQUEST_SECONDS, timed
+from SingleFlight import AsyncSingleFlight, SingleFlight
 
-# log = logging.getLogger(__name__)
+log = logging.getLogger('JupyterHub.oauth')
+
+# cn and ou of a group DN like cn=group,ou=groups,dc=example,dc=com
+DN_GROUP_PATTERN = r'cn=([^,]+),\s?ou=([^,]+)'
 # logging.basicConfig(level=logging.DEBUG)
 # log.debug("groups: %s", "test")
 
 
+class MyOAuthLoginHandler(OAuthLoginHandler):
+    """
+    Waits for the discovery document without blocking the hub, before redirecting to the OpenID Connect service.
+    """
+
+    async def get(self):
+        await self.authenticator.discover()
+        return super().get()
+
+
 class MyOAuth(GenericOAuthenticator):
     user_auth_state_key = 'oauth_user'
     group_path_in_userinfo = 'groups'
+    login_handler = MyOAuthLoginHandler
 
     discovery_url = Unicode(
             # default_value="",
@@ -32,21 +56,133 @@ class MyOAuth(GenericOAuthenticator):
     def _discovery_url_default(self):
         return os.environ.get("OAUTH2_DISCOVERY_URL", "")
 
+    discovery_cache_ttl = Float(
+            3600,
+            config=True,
+            help="""
+            Seconds the discovery document is used before it is refreshed in the background,
+            if the response has no Cache-Control max-age.
+            """,
+        )
+
+    discovery_cache_file = Unicode(
+            "/data/oidc_discovery.json",
+            config=True,
+            help="""
+            File the discovery documents are kept in, so that a restart of the hub does not wait for the OpenID Connect service.
+            Empty to keep them in memory only.
+            """,
+        )
+
+    discovery_timeout = Float(
+            10,
+            config=True,
+            help="""
+            Seconds to wait for the discovery document.
+            """,
+        )
+
+    verify_id_token = Bool(
+            False,
+            config=True,
+            help="""
+            Read the user (username and groups claims) from the ID token, verified with the keys (JWKS) of the OpenID Connect service,
+            instead of requesting the userinfo endpoint on every login.
+            The claims must be included in the ID token by the OpenID Connect service.
+            """,
+        )
+
+    id_token_leeway = Float(
+            30,
+            config=True,
+            help="""
+            Seconds of clock skew allowed when checking exp, iat and nbf of the ID token.
+            """,
+        )
+
+    jwks_min_refresh_interval = Float(
+            60,
+            config=True,
+            help="""
+            Minimum seconds between two fetches of the JWKS caused by an unknown key id, e.g. after a key rotation.
+            """,
+        )
+
+    group_mapping = List(
+            Dict(),
+            config=True,
+            help="""
+            Rules mapping the group paths of the groups claim (like /org/team/sub) to JupyterHub groups.
+            Each rule is a dict with a "prefix" (a group path) and an "action":
+            flatten (every segment), leaf (the last segment), path (the full path, like org/team/sub),
+            rename (the "name" of the rule) or drop (no group).
+            The rule with the longest prefix of a group path is used, group_mapping_default if none matches.
+            """,
+        )
+
+    group_mapping_default = Unicode(
+            "flatten",
+            config=True,
+            help="""
+            Action for the group paths matched by no rule of group_mapping. flatten maps /org/team to both org and team.
+            """,
+        )
+
+    group_dn_patterns = List(
+            Unicode(),
+            default_value=[DN_GROUP_PATTERN],
+            config=True,
+            help="""
+            Regular expressions for the entries of the groups claim which are DNs, the first group of the first match is the group name.
+            """,
+        )
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if not callable(self.claim_groups_key):
             #     # self.claim_groups_key = self.extract_group_from_dn
             self.claim_groups_key = self.get_user_groups
         self._oidc: OIDC_Endpoint = None
+        self._discovery_cache: DiscoveryCache = None
+        self._jwks: JwksCache = None
+        self._group_mapper: GroupMapping = None
 
+    @property
+    def group_mapper(self) -> GroupMapping:
+        """
+        group_mapping compiled, built once and rebuilt when the config changes
+        """
+        if self._group_mapper is None:
+            self._group_mapper = GroupMapping(self.group_mapping, default=self.group_mapping_default,
+                                              dn_patterns=self.group_dn_patterns)
+        return self._group_mapper
+
+    @observe("group_mapping", "group_mapping_default", "group_dn_patterns")
+    def _group_mapping_changed(self, change):
+        self._group_mapper = None
+
+    @property
+    def discovery_cache(self) -> DiscoveryCache:
+        if self._discovery_cache is None:
+            self._discovery_cache = DiscoveryCache(filename=self.discovery_cache_file or None,
+                                                   ttl=self.discovery_cache_ttl,
+                                                   timeout=self.discovery_timeout)
+        return self._discovery_cache
+
+    async def discover(self) -> OIDC_Endpoint | None:
+        """
+        Set the endpoints from the discovery document. It is fetched asynchronously if it is not cached yet.
+        """
+        data = await self.discovery_cache.get_async(self.discovery_url)
+        return self._pre_auth(self._endpoint(data))
 
-    @gen.coroutine
-    def authenticate(self, handler, data=None):
+    async def authenticate(self, handler, data=None):
         """
         This method is called when the user is authenticated.
         """
+        await self.discover()
         # Call the parent class method first
-        auth_model = yield super().authenticate(handler, data)
+        auth_model = await super().authenticate(handler, data)
         self.manage_groups = True
         if self.manage_groups:
             user_info = auth_model["auth_state"][self.user_auth_state_key]
@@ -58,35 +194,72 @@ class MyOAuth(GenericOAuthenticator):
             auth_model['groups'] = self.get_allowed_groups(groups)
         return auth_model
 
+    async def get_token_info(self, handler, params):
+        with timed(OIDC_REQUEST_SECONDS, 'token'):
+            return await super().get_token_info(handler, params)
+
+    async def token_to_user(self, token_info):
+        """
+        The user is read from the verified ID token if verify_id_token is set, otherwise from the userinfo endpoint.
+        """
+        if not self.verify_id_token:
+            with timed(OIDC_REQUEST_SECONDS, 'userinfo'):
+                return await super().token_to_user(token_info)
+        id_token = token_info.get("id_token", None)
+        if not id_token:
+            raise web.HTTPError(500, "An id token was not returned, the scope must contain openid")
+        with timed(OIDC_REQUEST_SECONDS, 'id_token'):
+            return await self.decode_id_token(id_token)
+
+    async def decode_id_token(self, id_token: str) -> dict:
+        """
+        Verify the signature, issuer, audience and lifetime of id_token and return its claims.
+        """
+        _oidc = await self.discover()
+        if _oidc is None or not _oidc.jwks_uri:
+            raise web.HTTPError(500, "The discovery document has no jwks_uri, can not verify the id token")
+        if self._jwks is None or self._jwks.jwks_uri != _oidc.jwks_uri:
+            self._jwks = JwksCache(_oidc.jwks_uri, min_refresh_interval=self.jwks_min_refresh_interval,
+                                   timeout=self.discovery_timeout)
+        try:
+            header = jwt.get_unverified_header(id_token)
+        except jwt.InvalidTokenError as e:
+            raise web.HTTPError(403, f"Invalid id token: {e}")
+        algorithm = header.get("alg")
+        if algorithm not in JwksCache.algorithms:
+            raise web.HTTPError(403, f"Id token signed with unsupported algorithm {algorithm}")
+        key = await self._jwks.get_key(header.get("kid"))
+        if key is None:
+            raise web.HTTPError(403, f"Id token signed with unknown key {header.get('kid')}")
+        try:
+            return jwt.decode(id_token, key=key.key, algorithms=[algorithm],
+                              audience=self.client_id, issuer=_oidc.issuer,
+                              leeway=self.id_token_leeway,
+                              options=dict(require=["exp", "iat"]))
+        except jwt.InvalidTokenError as e:
+            raise web.HTTPError(403, f"Invalid id token: {e}")
+
     def get_allowed_groups(self, groups: list[str]) -> list[str]:
         """
         Check if the user is in the allowed groups.
         If allowed_group is empty, then allow all groups.
         """
-        groups = set(groups)
-        allowed_groups = set(self.allowed_groups)
-        if len(allowed_groups) ==0:
-            return groups
-        groups_filter = allowed_groups.intersection(groups)
-        return list(groups_filter)
+        # allowed_groups is a set trait already
+        if len(self.allowed_groups) ==0:
+            return list(groups)
+        return list(self.allowed_groups.intersection(groups))
 
-    @classmethod
-    def get_user_groups(cls, user_info: dict[str, str]) -> list[str]:
+    def get_user_groups(self, user_info: dict[str, str]) -> set[str]:
         """
         Extract the groups from the user information.
 
         This is written for keycloak. The format of the groups is like this: /group1/subgroup, /group2, /group3.
+        They are mapped by group_mapping, by default every segment of a path is a group.
 
         If you don't use keycloak, you may need to override this method or set the claim_groups_key attribute(callable) to a function that extracts the groups from the user information.
         """
-        group_path_in_userinfo = cls.group_path_in_userinfo or 'groups'
-        groups = user_info.get(group_path_in_userinfo, [])
-        group_flat:list[str]=[]
-        for group in groups:
-            group_list=group.split('/')
-            group_list=[i for i in group_list if i.strip()!=""]
-            group_flat += group_list
-        return set(group_flat)
+        group_path_in_userinfo = self.group_path_in_userinfo or 'groups'
+        return set(self.group_mapper(user_info.get(group_path_in_userinfo)))
 
     @classmethod
     def extract_group_from_dn(self, user_info: dict[str, str]):
@@ -99,7 +272,7 @@ class MyOAuth(GenericOAuthenticator):
         groups = []
         for dn in dns:
             # match = re.match(r'cn=([^,]+)', dn)
-            match = re.match(r'cn=([^,]+),\s?ou=([^,]+)', dn)
+            match = _DN_GROUP.match(dn)
             if match:
                 groups.append(match.group(1))
         return groups
@@ -117,12 +290,10 @@ class MyOAuth(GenericOAuthenticator):
         """
         This method is called before the authentication process starts.
 
+        Only the cached discovery document is used, it never waits for the network. See discover().
         """
         if _oidc is None:
-            _oidc=self._oidc
-            if _oidc is None:
-                _oidc = OIDC_Endpoint.from_discovery_url(self.discovery_url)
-                self._oidc=_oidc                
+            _oidc = self._endpoint(self.discovery_cache.cached(self.discovery_url))
         if _oidc is not None and _oidc.valid:
             self.token_url = _oidc.token_url or self.token_url
             self.userdata_url = _oidc.userinfo_url or self.userdata_url
@@ -138,7 +309,362 @@ class MyOAuth(GenericOAuthenticator):
             return _oidc
         else:
             return None
-        
+
+    def _endpoint(self, data: dict | None) -> OIDC_Endpoint | None:
+        """
+        the endpoints of the discovery document data, rebuilt only when the document changed
+        """
+        if data is not None and (self._oidc is None or self._oidc.data is not data):
+            self._oidc = OIDC_Endpoint.from_discovery_data(self.discovery_url, data)
+        return self._oidc
+
+
+_DN_GROUP = re.compile(DN_GROUP_PATTERN)
+
+
+@dataclass
+class GroupRule:
+    prefix: str
+    action: str = 'flatten'
+    # the group name of the rename action
+    name: str = None
+
+
+class _GroupNode:
+    __slots__ = ('children', 'rule')
+
+    def __init__(self) -> None:
+        self.children: dict[str, _GroupNode] = {}
+        self.rule: GroupRule = None
+
+
+class GroupMapping:
+    """
+    Maps a groups claim to group names, with rules compiled once.\n
+    Group paths (/org/team/sub) are looked up in a trie of the rule prefixes, the rule of the longest prefix is used.
+    Other entries are matched against the precompiled DN patterns.
+    The result is memoized per distinct groups claim, so users of the same groups are mapped once.
+    """
+    actions = ('flatten', 'leaf', 'path', 'rename', 'drop')
+
+    def __init__(self, rules: list[dict] = (), default: str = 'flatten', dn_patterns: list[str] = (DN_GROUP_PATTERN,),
+                 cache_size: int = 4096) -> None:
+        if default not in self.actions or default == 'rename':
+            raise ValueError(f"invalid default group action {default}")
+        self._root = _GroupNode()
+        self._root.rule = GroupRule(prefix='/', action=default)
+        for rule in rules:
+            self.add_rule(GroupRule(**rule))
+        self._dn_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in dn_patterns]
+        self.map = lru_cache(maxsize=cache_size)(self._map)
+
+    @classmethod
+    def segments(cls, path: str) -> list[str]:
+        return [segment for segment in path.split('/') if segment.strip() != ""]
+
+    def add_rule(self, rule: GroupRule):
+        if rule.action not in self.actions:
+            raise ValueError(f"invalid group action {rule.action} for {rule.prefix}")
+        if rule.action == 'rename' and not rule.name:
+            raise ValueError(f"group rule rename of {rule.prefix} has no name")
+        node = self._root
+        for segment in self.segments(rule.prefix):
+            node = node.children.setdefault(segment, _GroupNode())
+        node.rule = rule
+
+    def _rule(self, segments: list[str]) -> GroupRule:
+        node = self._root
+        rule = node.rule
+        for segment in segments:
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.rule is not None:
+                rule = node.rule
+        return rule
+
+    def map_path(self, path: str) -> list[str]:
+        segments = self.segments(path)
+        if len(segments) == 0:
+            return []
+        rule = self._rule(segments)
+        if rule.action == 'flatten':
+            return segments
+        if rule.action == 'leaf':
+            return [segments[-1]]
+        if rule.action == 'path':
+            return ['/'.join(segments)]
+        if rule.action == 'rename':
+            return [rule.name]
+        return []
+
+    def map_dn(self, dn: str) -> list[str]:
+        for pattern in self._dn_patterns:
+            match = pattern.match(dn)
+            if match:
+                return [match.group(1)]
+        return []
+
+    def _map(self, groups) -> frozenset[str]:
+        if groups is None:
+            return frozenset()
+        if isinstance(groups, str):
+            groups = (groups,)
+        mapped: set[str] = set()
+        for group in groups:
+            if group.startswith('/') or '=' not in group:
+                mapped.update(self.map_path(group))
+            else:
+                mapped.update(self.map_dn(group))
+        return frozenset(mapped)
+
+    def __call__(self, groups) -> frozenset[str]:
+        # lists are not hashable, the claim is memoized as a tuple
+        if isinstance(groups, list):
+            groups = tuple(groups)
+        return self.map(groups)
+
+
+@dataclass
+class DiscoveryEntry:
+    data: dict
+    fetched_at: float
+    expires_at: float
+    # the URL which answered, tried first on refresh
+    url: str = None
+
+    @property
+    def expired(self) -> bool:
+        return time.time() > self.expires_at
+
+
+class DiscoveryCache:
+    """
+    OIDC discovery documents by discovery URL, in memory and in a json file.\n
+    A document is used until it expires (Cache-Control max-age, or ttl), after that it is still used while it is refreshed in the background.
+    The background refresh runs on the event loop if there is one, otherwise in a thread.
+    """
+    # lower bound of the lifetime, a response with no-cache does not cause a request per login
+    min_ttl: float = 60
+
+    def __init__(self, filename: str = None, ttl: float = 3600, timeout: float = 10) -> None:
+        self.filename = filename
+        self.ttl = ttl
+        self.timeout = timeout
+        self._entries: dict[str, DiscoveryEntry] = {}
+        self._lock = threading.Lock()
+        # running fetches by discovery URL, shared by the logins waiting for them
+        self._flight = SingleFlight()
+        self._async_flight = AsyncSingleFlight()
+        self.load()
+
+    def get(self, discovery_url: str) -> dict | None:
+        """
+        the discovery document of discovery_url. It is only fetched while waiting if it was never fetched before.
+        """
+        if not discovery_url:
+            return None
+        entry = self._entries.get(discovery_url)
+        if entry is None:
+            return self.refresh(discovery_url)
+        if entry.expired:
+            self.refresh_later(discovery_url)
+        return entry.data
+
+    async def get_async(self, discovery_url: str) -> dict | None:
+        """
+        get, without blocking the event loop while the document is fetched
+        """
+        if not discovery_url:
+            return None
+        entry = self._entries.get(discovery_url)
+        if entry is None:
+            return await self.refresh_async(discovery_url)
+        if entry.expired:
+            self.refresh_later(discovery_url)
+        return entry.data
+
+    def cached(self, discovery_url: str) -> dict | None:
+        """
+        the cached document of discovery_url, never waits. A missing or expired document is fetched in the background.
+        """
+        if not discovery_url:
+            return None
+        entry = self._entries.get(discovery_url)
+        if entry is None or entry.expired:
+            self.refresh_later(discovery_url)
+        return None if entry is None else entry.data
+
+    async def refresh_async(self, discovery_url: str) -> dict | None:
+        """
+        refresh, without blocking the event loop. Concurrent calls for the same URL share one fetch.
+        """
+        return await self._async_flight.do(('discovery', discovery_url), self._refresh_async, discovery_url)
+
+    async def _refresh_async(self, discovery_url: str) -> dict | None:
+        start = time.perf_counter()
+        entry = self._entries.get(discovery_url)
+        data = None
+        if entry is not None and entry.url is not None:
+            url = entry.url
+            data, max_age = await OIDC_Endpoint.fetch_discovery_info_async(url, timeout=self.timeout)
+        if data is None:
+            data, max_age, url = await OIDC_Endpoint.probe_discovery_info_async(discovery_url, timeout=self.timeout)
+        OIDC_DISCOVERY_SECONDS.labels('error' if data is None else 'ok').observe(time.perf_counter() - start)
+        if data is None:
+            return None if entry is None else entry.data
+        return self.put(discovery_url, data, max_age, url)
+
+    def refresh(self, discovery_url: str) -> dict | None:
+        """
+        fetch the discovery document of discovery_url. On failure the cached document, if any, is kept and returned.
+        Concurrent calls for the same URL share one fetch.
+        """
+        return self._flight.do(('discovery', discovery_url), self._refresh, discovery_url)
+
+    def _refresh(self, discovery_url: str) -> dict | None:
+        start = time.perf_counter()
+        entry = self._entries.get(discovery_url)
+        data = None
+        if entry is not None and entry.url is not None:
+            url = entry.url
+            data, max_age = OIDC_Endpoint.fetch_discovery_info(url, timeout=self.timeout)
+        if data is None:
+            data, max_age, url = OIDC_Endpoint.probe_discovery_info(discovery_url, timeout=self.timeout)
+        OIDC_DISCOVERY_SECONDS.labels('error' if data is None else 'ok').observe(time.perf_counter() - start)
+        if data is None:
+            return None if entry is None else entry.data
+        return self.put(discovery_url, data, max_age, url)
+
+    def put(self, discovery_url: str, data: dict, max_age: float = None, url: str = None) -> dict:
+        now = time.time()
+        ttl = self.ttl if max_age is None else max(max_age, self.min_ttl)
+        with self._lock:
+            self._entries[discovery_url] = DiscoveryEntry(data=data, fetched_at=now, expires_at=now + ttl, url=url)
+        self.save()
+        return data
+
+    def refresh_later(self, discovery_url: str) -> bool:
+        """
+        refresh discovery_url in a background thread. Return False if a refresh is already running.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        key = ('discovery', discovery_url)
+        if loop is not None:
+            return self._async_flight.do_later(key, self._refresh_async, discovery_url)
+        return self._flight.do_later(key, self._refresh, discovery_url, name='oidc-discovery')
+
+    def load(self):
+        """
+        read the documents of the last run. They are used at once and refreshed when expired.
+        """
+        if self.filename is None or not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+            self._entries = {url: DiscoveryEntry(**entry) for url, entry in entries.items()}
+        except (OSError, ValueError, TypeError) as e:
+            log.warning("can not read the discovery cache %s: %s", self.filename, e)
+
+    def save(self):
+        if self.filename is None:
+            return
+        with self._lock:
+            entries = {url: asdict(entry) for url, entry in self._entries.items()}
+        tmp = f"{self.filename}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.filename)
+        except OSError as e:
+            log.warning("can not write the discovery cache %s: %s", self.filename, e)
+
+
+class JwksCache:
+    """
+    The signing keys (JWKS) of the OpenID Connect service by key id.\n
+    A key id that is not known, e.g. after a key rotation, causes a new fetch, at most once per min_refresh_interval.
+    A failed fetch keeps the known keys and is retried after min_refresh_interval.
+    """
+    # asymmetric algorithms only, the id token must not be accepted with "none" or a shared secret
+    algorithms = ("RS256", "RS384", "RS512", "PS256", "PS384", "PS512", "ES256", "ES384", "ES512", "EdDSA")
+
+    def __init__(self, jwks_uri: str, ttl: float = 86400, min_refresh_interval: float = 60, timeout: float = 10) -> None:
+        self.jwks_uri = jwks_uri
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys: dict[str, jwt.PyJWK] = {}
+        # time of the last fetch, and when the keys are fetched again
+        self._fetched_at: float = None
+        self._refresh_at: float = None
+        self._flight = AsyncSingleFlight()
+
+    async def get_key(self, kid: str | None) -> jwt.PyJWK | None:
+        """
+        the key of kid. If kid is None, the only key of the set.
+        """
+        if self._flight.in_flight(('jwks', self.jwks_uri)):
+            # the fetch in flight may bring the key, _fetched_at is already set by it
+            await self.refresh()
+        now = time.monotonic()
+        if self._refresh_at is None or now >= self._refresh_at:
+            await self.refresh()
+        key = self._find(kid)
+        if key is None and now - self._fetched_at > self.min_refresh_interval:
+            await self.refresh()
+            key = self._find(kid)
+        return key
+
+    def _find(self, kid: str | None) -> jwt.PyJWK | None:
+        if kid is None:
+            return next(iter(self._keys.values())) if len(self._keys) == 1 else None
+        return self._keys.get(kid)
+
+    async def refresh(self):
+        """
+        fetch the key set. Concurrent calls share one fetch. On failure the known keys are kept.
+        """
+        await self._flight.do(('jwks', self.jwks_uri), self._refresh)
+
+    async def _refresh(self):
+        self._fetched_at = time.monotonic()
+        # until the fetch succeeded
+        self._refresh_at = self._fetched_at + self.min_refresh_interval
+        request = HTTPRequest(self.jwks_uri, connect_timeout=self.timeout, request_timeout=self.timeout)
+        try:
+            response = await AsyncHTTPClient().fetch(request, raise_error=False)
+        except (HTTPClientError, OSError, asyncio.TimeoutError) as e:
+            # raise_error=False only covers HTTP errors, there is no response, e.g. connection refused or a timeout
+            log.warning("Failed to retrieve %s: %s", self.jwks_uri, e)
+            return
+        if response.code != 200:
+            log.warning("Failed to retrieve %s: Status code %s", self.jwks_uri, response.code)
+            return
+        try:
+            jwk_set = json.loads(response.body)
+        except ValueError as e:
+            log.warning("Invalid JWKS from %s: %s", self.jwks_uri, e)
+            return
+        keys = {}
+        for jwk in jwk_set.get("keys", []):
+            if jwk.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[jwk.get("kid")] = jwt.PyJWK(jwk)
+            except jwt.PyJWTError as e:
+                # e.g. a key type not supported without the cryptography package
+                log.debug("Skipping key %s of %s: %s", jwk.get("kid"), self.jwks_uri, e)
+        self._keys = keys
+        self._refresh_at = self._fetched_at + self.ttl
+
+
+# fetches of the same discovery URL without a DiscoveryCache, e.g. by concurrent first logins, share one request
+_discovery_flight = SingleFlight()
 
 
 @dataclass
@@ -148,14 +674,26 @@ class OIDC_Endpoint:
     userinfo_url: str = field(default=None)
     authorize_url: str = field(default=None)
     logout_redirect_url: str = field(default=None)
+    data: dict = field(default=None, repr=False)
 
     def __post_init__(self):
-        self.extract_endpoint()
+        if self.data is not None:
+            self._apply(self.data)
+        elif self.token_url is None:
+            self.extract_endpoint()
     
     @property
     def valid(self) -> bool:
         return self._is_valid()
 
+    @property
+    def issuer(self) -> str | None:
+        return None if self.data is None else self.data.get("issuer")
+
+    @property
+    def jwks_uri(self) -> str | None:
+        return None if self.data is None else self.data.get("jwks_uri")
+
     def extract_endpoint(self, discovery_url: str = None) -> bool:
         """
         Extract the endpoint from the discovery URL. 
@@ -172,11 +710,15 @@ class OIDC_Endpoint:
         data = self.get_discovery_info2(discovery_url)
         if data is None:
             return False
+        self._apply(data)
+        return True
+
+    def _apply(self, data: dict):
+        self.data = data
         self.token_url = data.get("token_endpoint")
         self.userinfo_url = data.get("userinfo_endpoint")
         self.authorize_url = data.get("authorization_endpoint")
         self.logout_redirect_url = data.get("end_session_endpoint")
-        return True
     
     def _is_valid(self) -> bool:
         return self.token_url is not None and self.userinfo_url is not None and self.authorize_url is not None and self.logout_redirect_url is not None
@@ -187,36 +729,103 @@ class OIDC_Endpoint:
         Create an instance of the class from the discovery URL.
 
         """
-        data = cls.get_discovery_info2(discovery_url)
+        data = _discovery_flight.do(('discovery', discovery_url), cls.get_discovery_info2, discovery_url)
         if data is None:
             return None
-        return cls(discovery_url=discovery_url)
+        return cls.from_discovery_data(discovery_url, data)
+
+    @classmethod
+    def from_discovery_data(cls, discovery_url: str, data: dict) -> "OIDC_Endpoint":
+        """
+        Create an instance of the class from a discovery document which was already fetched.
 
+        """
+        return cls(discovery_url=discovery_url, data=data)
 
     @classmethod
-    def get_discovery_info(cls, discovery_url: str) -> dict|None:
+    def get_discovery_info(cls, discovery_url: str, timeout: float = 10) -> dict|None:
         """
         Get the discovery information from the discovery URL.
 
+        """
+        return cls.fetch_discovery_info(discovery_url, timeout)[0]
+
+    @classmethod
+    def fetch_discovery_info(cls, discovery_url: str, timeout: float = 10) -> tuple[dict|None, float|None]:
+        """
+        Get the discovery information and its Cache-Control max-age (None if not given) from the discovery URL.
+
         """
         if discovery_url is None or not isinstance(discovery_url, str) or len(discovery_url) == 0:
-            return None
-        response = requests.get(discovery_url)
+            return None, None
+        try:
+            response = requests.get(discovery_url, timeout=timeout)
+        except requests.RequestException as e:
+            log.warning("Failed to retrieve %s: %s", discovery_url, e)
+            return None, None
         # check if the request is successful
         if response.status_code == 200:
             # analyze the JSON response
-            data = response.json()
-            if "issuer" in data and isinstance(data['issuer'], str):
-                return data
-            return None
+            try:
+                data = response.json()
+            except ValueError:
+                return None, None
+            if isinstance(data, dict) and "issuer" in data and isinstance(data['issuer'], str):
+                return data, cls.max_age(response.headers.get("Cache-Control"))
+            return None, None
         else:
-            print("Failed to retrieve data: Status code", response.status_code)
+            # expected while probing the candidate URLs
+            log.debug("Failed to retrieve %s: Status code %s", discovery_url, response.status_code)
+            return None, None
+
+    @classmethod
+    async def fetch_discovery_info_async(cls, discovery_url: str, timeout: float = 10) -> tuple[dict|None, float|None]:
+        """
+        fetch_discovery_info, with tornado's AsyncHTTPClient.
+        """
+        if discovery_url is None or not isinstance(discovery_url, str) or len(discovery_url) == 0:
+            return None, None
+        request = HTTPRequest(discovery_url, connect_timeout=timeout, request_timeout=timeout)
+        try:
+            response = await AsyncHTTPClient().fetch(request, raise_error=False)
+        except (HTTPClientError, OSError, asyncio.TimeoutError) as e:
+            # raise_error=False only covers HTTP errors, there is no response, e.g. connection refused or a timeout
+            log.warning("Failed to retrieve %s: %s", discovery_url, e)
+            return None, None
+        if response.code != 200:
+            # expected while probing the candidate URLs
+            log.debug("Failed to retrieve %s: Status code %s", discovery_url, response.code)
+            return None, None
+        try:
+            data = json.loads(response.body)
+        except ValueError:
+            return None, None
+        if isinstance(data, dict) and "issuer" in data and isinstance(data['issuer'], str):
+            return data, cls.max_age(response.headers.get("Cache-Control"))
+        return None, None
+
+    @classmethod
+    def max_age(cls, cache_control: str | None) -> float | None:
+        """
+        max-age of a Cache-Control header, 0 for no-cache or no-store, None if not given.
+        """
+        if not cache_control:
             return None
+        for directive in cache_control.lower().split(','):
+            name, _, value = directive.strip().partition('=')
+            if name in ('no-cache', 'no-store'):
+                return 0
+            if name == 'max-age':
+                try:
+                    return float(value.strip('"'))
+                except ValueError:
+                    return None
+        return None
 
     @classmethod
-    def get_discovery_info2(cls, discovery_url: str) -> dict:
+    def discovery_url_list(cls, discovery_url: str) -> list[str]:
         """
-        Try to parse the discovery URL and get the discovery information from the URL.
+        The URLs the discovery document may be found at, the given one first.
         """
         suffix = "/.well-known/openid-configuration"
         parsed_url = urlparse(discovery_url)
@@ -226,18 +835,59 @@ class OIDC_Endpoint:
         else:
             discovery_url_list.append(f"{parsed_url.scheme}://{parsed_url.netloc}{suffix}")
             discovery_url_list.append(f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path}{suffix}")
-        for url in discovery_url_list:
-            data = cls.get_discovery_info(url)
+        return discovery_url_list
+
+    @classmethod
+    def get_discovery_info2(cls, discovery_url: str, timeout: float = 10) -> dict:
+        """
+        Try to parse the discovery URL and get the discovery information from the URL.
+        """
+        return cls.probe_discovery_info(discovery_url, timeout)[0]
+
+    @classmethod
+    def probe_discovery_info(cls, discovery_url: str, timeout: float = 10) -> tuple[dict|None, float|None, str|None]:
+        """
+        get_discovery_info2, with the Cache-Control max-age of the response and the URL which answered.
+        """
+        if not discovery_url:
+            return None, None, None
+        for url in cls.discovery_url_list(discovery_url):
+            data, max_age = cls.fetch_discovery_info(url, timeout)
             if data is not None:
-                return data
-        return None
+                return data, max_age, url
+        return None, None, None
+
+    @classmethod
+    async def probe_discovery_info_async(cls, discovery_url: str, timeout: float = 10) -> tuple[dict|None, float|None, str|None]:
+        """
+        probe_discovery_info, with all candidate URLs requested at the same time.
+        The first valid response is used and the other requests are cancelled.
+        """
+        if not discovery_url:
+            return None, None, None
+        tasks = {asyncio.ensure_future(cls.fetch_discovery_info_async(url, timeout)): url
+                 for url in cls.discovery_url_list(discovery_url)}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled() or task.exception() is not None:
+                        continue
+                    data, max_age = task.result()
+                    if data is not None:
+                        return data, max_age, tasks[task]
+        finally:
+            for task in pending:
+                task.cancel()
+        return None, None, None
 
 
 if __name__ == "__main__":
     discovery_url = "https://auth.eqe-lab.com/realms/eqe"
     MyOAuth.discovery_url = discovery_url
     auth = MyOAuth()
-    auth._pre_auth()
+    asyncio.run(auth.discover())
 
     # response = requests.get(url)
     # if response.status_code == 200:
@@ -0,0 +1,130 @@
+from __future__ import annotations
+from concurrent.futures import Executor
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Hashable
+from Metrics import SINGLE_FLIGHT_SHARED
+
+
+def _operation(key: Hashable) -> str:
+    """
+    the metric label of key, the first item of an (operation, argument) key
+    """
+    return str(key[0]) if isinstance(key, tuple) and key else str(key)
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException = None
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key, e.g. ('lookup', username), share one call of the function.\n
+    The first caller runs it, the others wait for it and get its result, or its exception.
+    A call that has finished is not remembered, the next caller runs the function again.
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._calls
+
+    def _join(self, key: Hashable) -> tuple[_Call, bool]:
+        """
+        the call of key and whether the caller has to run it
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def _run(self, key: Hashable, call: _Call, fn: Callable, args: tuple, kwargs: dict):
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs):
+        """
+        fn(*args, **kwargs), or the result of the call of key already in flight
+        """
+        call, leader = self._join(key)
+        if leader:
+            self._run(key, call, fn, args, kwargs)
+        else:
+            SINGLE_FLIGHT_SHARED.labels(_operation(key)).inc()
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do_later(self, key: Hashable, fn: Callable, *args, executor: Executor = None, name: str = None, **kwargs) -> bool:
+        """
+        run fn on executor, or in a daemon thread, unless a call of key is in flight. Return False if it was.\n
+        Callers of do(key) meanwhile wait for this call. Its exception is only passed to them.
+        """
+        call, leader = self._join(key)
+        if not leader:
+            return False
+        if executor is not None:
+            executor.submit(self._run, key, call, fn, args, kwargs)
+        else:
+            threading.Thread(target=self._run, args=(key, call, fn, args, kwargs), name=name, daemon=True).start()
+        return True
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines on one event loop.\n
+    The call runs as a task, so a caller that is cancelled does not cancel it for the others.
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def _join(self, key: Hashable, fn: Callable[..., Awaitable], args: tuple, kwargs: dict) -> tuple[asyncio.Future, bool]:
+        future = self._calls.get(key)
+        # a call of a loop which was closed before it finished never finishes
+        if future is not None and future.get_loop() is asyncio.get_running_loop():
+            return future, False
+        future = self._calls[key] = asyncio.ensure_future(fn(*args, **kwargs))
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future, True
+
+    def _done(self, key: Hashable, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        # the exception was passed to the waiters, or there were none
+        if not future.cancelled():
+            future.exception()
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable], *args, **kwargs):
+        """
+        await fn(*args, **kwargs), or the result of the call of key already in flight
+        """
+        future, leader = self._join(key, fn, args, kwargs)
+        if not leader:
+            SINGLE_FLIGHT_SHARED.labels(_operation(key)).inc()
+        return await asyncio.shield(future)
+
+    def do_later(self, key: Hashable, fn: Callable[..., Awaitable], *args, **kwargs) -> bool:
+        """
+        start fn as a task unless a call of key is in flight. Return False if it was.
+        """
+        future, leader = self._join(key, fn, args, kwargs)
+        return leader